@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# entry points that must start without loading any heavy backend
+ENTRY_POINTS = [
+    "eval/score_compute.py",
+    "eval/threshold_sweep.py",
+    "data_construction/fake_annotation/annotation_low_level.py",
+    "data_construction/fake_annotation/annotation_high_level.py",
+    "data_construction/fake_annotation/annotation_high_level_refine.py",
+    "data_construction/fake_annotation/annotation_combine.py",
+    "data_construction/real_annotation/annotation_real.py",
+    "data_construction/real_annotation/annotation_real_combine.py",
+    "data_construction/real_annotation/image_screening.py",
+    "data_construction/final_json_create.py",
+    "data_construction/image_dedup.py",
+    "data_construction/manual_annotation/label_studio_json_create.py",
+]
+
+# backends that are only loaded once a metric or provider actually needs them
+HEAVY_MODULES = ["torch", "sentence_transformers", "evaluate", "openai", "azure", "PIL", "diffusers", "onnxruntime"]
+
+
+def measure_import_time(script):
+    """
+    run `script --help` with -X importtime and return (wall time in seconds, cumulative import time in seconds,
+    imported top-level package names, exit code)
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.join(REPO_ROOT, script), "--help"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+    )
+    wall_time = time.perf_counter() - start
+
+    import_time_us = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        # import time:       self [us] |  cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        packages.add(name.strip().split(".")[0])
+        # only top-level imports (no indentation) so nested imports are not counted twice
+        if not name.startswith("  "):
+            import_time_us += int(cumulative)
+
+    return wall_time, import_time_us / 1e6, packages, result.returncode
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure startup import time of the CLI entry points with `python -X importtime`.")
+    parser.add_argument("--budget", type=float, default=1.0, help="Maximum allowed wall time in seconds for `<script> --help`.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per entry point, the best one is reported.")
+    parser.add_argument("--scripts", nargs="*", default=ENTRY_POINTS, help="Entry points to measure, relative to the repository root.")
+    args = parser.parse_args()
+
+    failures = []
+    for script in args.scripts:
+        runs = [measure_import_time(script) for _ in range(args.repeat)]
+        wall_time, import_time, packages, returncode = min(runs, key=lambda run: run[0])
+        heavy = sorted(packages.intersection(HEAVY_MODULES))
+
+        status = "ok"
+        if returncode != 0:
+            status = f"FAIL (exit code {returncode})"
+        elif heavy:
+            status = f"FAIL (imports {', '.join(heavy)})"
+        elif wall_time > args.budget:
+            status = f"FAIL (over {args.budget:.2f}s budget)"
+        if status != "ok":
+            failures.append(script)
+
+        print(f"{script:70s} wall {wall_time * 1000:7.1f} ms | imports {import_time * 1000:7.1f} ms | {status}")
+
+    if failures:
+        print(f"{len(failures)} entry point(s) failed the startup check")
+        raise SystemExit(1)
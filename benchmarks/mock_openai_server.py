@@ -0,0 +1,285 @@
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+CHAT_PATHS = re.compile(r"^(/v1)?/chat/completions$|^/openai/deployments/[^/]+/chat/completions$")
+
+
+def parse_latency(spec):
+    """
+    latency sampler in seconds from "fixed:MS", "uniform:LOW_MS:HIGH_MS" or "lognormal:MEDIAN_MS:SIGMA"
+    """
+    kind, *values = spec.split(":")
+    values = [float(value) for value in values]
+    if kind == "fixed":
+        return lambda rng: values[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal":
+        return lambda rng: values[0] * rng.lognormvariate(0, values[1]) / 1000
+    raise ValueError(f"Unknown latency distribution {spec}")
+
+
+def request_key(body):
+    """
+    key of a chat request for record/replay: model and text parts verbatim, images by the hash of their url
+    """
+    parts = [body.get("model", "")]
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                parts.append(part["text"])
+            elif part.get("type") == "image_url":
+                parts.append(hashlib.sha256(part["image_url"]["url"].encode()).hexdigest())
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def request_text(body):
+    texts = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part["text"] for part in content or [] if part.get("type") == "text")
+    return "\n".join(texts)
+
+
+def count_images(body):
+    return sum(
+        part.get("type") == "image_url"
+        for message in body.get("messages", []) if isinstance(message.get("content"), list)
+        for part in message["content"]
+    )
+
+
+def synthetic_content(text):
+    """
+    plausible answer in the format each stage of the pipeline parses
+    """
+    points = "\n".join(f"<begin_of_point>\n**Mock Error {i}**: synthetic description number {i}.\n<end_of_point>" for i in range(1, 4))
+
+    packed = re.search(r"You are given (\d+) images", text)
+    if packed:
+        return "\n".join(f"<begin_of_image_{i}>\n{points}\n<end_of_image_{i}>" for i in range(1, int(packed.group(1)) + 1))
+    if "<begin_of_json>" in text:
+        return 'Every point is present in the image.\n<begin_of_json>\n[{"type": "revise", "location": 1, "content": "revised point"}]\n<end_of_json>'
+    if "similarity score" in text:
+        return "The sentences are closely related. \\boxed{0.8}"
+    if "<begin_of_low_level_errors>" in text:
+        label = "real" if "for a real image" in text else "AI-generated"
+        return (f"<begin_of_low_level_errors>\n{points}\n<end_of_low_level_errors>\n\n"
+                f"<begin_of_high_level_errors>\n{points}\n<end_of_high_level_errors>\n\n"
+                f"**Conclusion**: the image is judged to be \\boxed{{{label}}}.")
+    return points
+
+
+class MockState:
+    """
+    shared state of the server: replay table, rate-limit window, random generator and request statistics
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.rng = random.Random(args.seed)
+        self.latency = parse_latency(args.latency)
+        self.replay = {}
+        if args.replay:
+            with open(args.replay, "r", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.replay[record["key"]] = record["response"]
+        self.window_start, self.window_requests = time.monotonic(), 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.records = []
+
+    def sample(self):
+        """
+        (status, injected latency in seconds, seconds until the rate-limit window resets, remaining requests)
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.window_start, self.window_requests = now, 0
+            self.window_requests += 1
+            reset = 60 - (now - self.window_start)
+            remaining = max(self.args.rpm - self.window_requests, 0) if self.args.rpm else 1_000_000
+
+            draw = self.rng.random()
+            if self.args.rpm and self.window_requests > self.args.rpm:
+                status = 429
+            elif draw < self.args.error_rate_429:
+                status = 429
+            elif draw < self.args.error_rate_429 + self.args.error_rate_500:
+                status = 500
+            else:
+                status = 200
+            return status, self.latency(self.rng), reset, remaining
+
+    def record(self, status, latency, num_images):
+        """
+        latency is the time spent handling the request, including the injected delay
+        """
+        with self.lock:
+            self.records.append((status, latency, num_images))
+
+    def stats(self):
+        with self.lock:
+            records = list(self.records)
+        latencies = np.array([latency for status, latency, _ in records if status == 200])
+        status_counts = {}
+        for status, _, _ in records:
+            status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+
+        def percentile(q):
+            return float(np.percentile(latencies, q)) if len(latencies) else 0.0
+
+        return {
+            "requests": len(records),
+            "status_counts": status_counts,
+            "images": sum(num_images for status, _, num_images in records if status == 200),
+            "p50_latency": percentile(50),
+            "p95_latency": percentile(95),
+            "p99_latency": percentile(99),
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.state.stats())
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/stats/reset":
+            self.state.reset_stats()
+            self.send_json(200, {})
+            return
+        if not CHAT_PATHS.match(self.path.split("?", 1)[0]):
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+
+        args = self.state.args
+        num_images = count_images(body)
+        status, latency, reset, remaining = self.state.sample()
+        latency += num_images * args.per_image_ms / 1000
+        headers = {
+            "x-ratelimit-limit-requests": str(args.rpm or 1_000_000),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+
+        if status == 429:
+            # rate-limited requests are rejected at once, without the generation latency
+            self.state.record(status, time.perf_counter() - start, num_images)
+            headers["retry-after-ms"] = str(int(args.retry_after_ms))
+            self.send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}}, headers)
+            return
+
+        time.sleep(latency)
+        if status == 500:
+            self.state.record(status, time.perf_counter() - start, num_images)
+            self.send_json(500, {"error": {"message": "The server had an error (mock)", "type": "server_error"}}, headers)
+            return
+
+        key = request_key(body)
+        if args.record:
+            response = self.forward(body)
+            with self.state.lock:
+                with open(args.record, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key, "response": response}) + "\n")
+        elif key in self.state.replay:
+            response = self.state.replay[key]
+        else:
+            content = synthetic_content(request_text(body))
+            prompt_tokens = len(request_text(body)) // 4 + 765 * num_images
+            completion_tokens = len(content) // 4
+            response = {
+                "id": f"chatcmpl-mock-{key[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+            }
+
+        self.state.record(200, time.perf_counter() - start, num_images)
+        self.send_json(200, response, headers)
+
+    def forward(self, body):
+        """
+        send the request to the real API and return its response, for --record
+        """
+        request = urllib.request.Request(
+            self.state.args.upstream.rstrip("/") + "/chat/completions",
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json", "Authorization": self.headers.get("Authorization", "")},
+        )
+        with urllib.request.urlopen(request, timeout=300) as response:
+            return json.loads(response.read())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible chat completions server for offline load tests.")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--latency", default="lognormal:800:0.4", help="Latency distribution: fixed:MS, uniform:LOW_MS:HIGH_MS or lognormal:MEDIAN_MS:SIGMA.")
+    parser.add_argument("--per_image_ms", type=float, default=200, help="Extra latency per attached image.")
+    parser.add_argument("--error_rate_429", type=float, default=0.0, help="Fraction of requests answered with 429 Too Many Requests.")
+    parser.add_argument("--error_rate_500", type=float, default=0.0, help="Fraction of requests answered with 500 Internal Server Error.")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before every request is answered with 429 (0 for no limit).")
+    parser.add_argument("--retry_after_ms", type=float, default=100, help="retry-after-ms header of 429 responses.")
+    parser.add_argument("--replay", default=None, help="JSONL file of recorded responses, returned for matching requests.")
+    parser.add_argument("--record", default=None, help="JSONL file receiving the responses of --upstream for every request.")
+    parser.add_argument("--upstream", default="https://api.openai.com/v1", help="Real API base url used with --record.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency and error sampling.")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    MockHandler.state = MockState(args)
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    print(f"Mock OpenAI server on http://{args.host}:{args.port}/v1 (set OPENAI_BASE_URL to this url)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
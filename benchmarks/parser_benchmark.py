@@ -0,0 +1,86 @@
+import time
+import random
+import argparse
+
+from utils.utils import parse_text, iter_annotations
+# the regex reference implementations live with the parser tests
+from tests.test_annotation_parser import LOW_START, LOW_END, HIGH_START, HIGH_END, legacy_parse_annotation, legacy_parse_text, new_parse_annotation
+
+
+# ====== Corpus ======
+
+def random_point(rng):
+    words = ["hand", "shadow", "texture", "**Lighting Artifact**:", "finger", "reflection", "blur", "sign", "text"]
+    return " ".join(rng.choice(words) for _ in range(rng.randint(5, 40)))
+
+
+def random_annotation(rng):
+    """
+    structured annotation in the benchmark format, with occasional malformed markers
+    """
+    def section(start, end):
+        points = [f"<begin_of_point>\n{random_point(rng)}\n<end_of_point>" for _ in range(rng.randint(0, 6))]
+        if points and rng.random() < 0.1:
+            points[-1] = points[-1].replace("<end_of_point>", "")
+        body = "\n".join(points)
+        if rng.random() < 0.2:
+            body = random_point(rng) + "\n" + body + "\n" + random_point(rng)
+        return f"{start}\n{body}\n{end}" if rng.random() < 0.95 else f"{start}\n{body}"
+
+    parts = []
+    if rng.random() < 0.8:
+        parts.append(section(LOW_START, LOW_END))
+    if rng.random() < 0.8:
+        parts.append(section(HIGH_START, HIGH_END))
+    else:
+        parts.append(section("", ""))
+    label = rng.choice(["AI-generated", "real", "", "AI-\ngenerated"])
+    if rng.random() < 0.9:
+        parts.append(f"**Conclusion**: the image is judged to be \\boxed{{{label}}}.")
+    return rng.choice(["", "  ", "\n"]) + "\n\n".join(parts) + rng.choice(["", "\n", " "])
+
+
+def load_corpus(args):
+    if args.annotation_file:
+        corpus = []
+        for sample in iter_annotations(args.annotation_file):
+            corpus.extend([sample["ground_truth"], sample["generated"]])
+        return corpus
+    rng = random.Random(args.seed)
+    return [random_annotation(rng) for _ in range(args.num_samples)]
+
+
+def time_function(function, corpus, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            function(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the single-pass annotation parser against the regex helpers.")
+    parser.add_argument("--annotation_file", default=None, help="JSON/JSONL file with ground_truth and generated annotations (synthetic corpus if not given).")
+    parser.add_argument("--num_samples", type=int, default=100000, help="Size of the synthetic corpus.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions, the best one is reported.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus.")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args)
+
+    mismatches = 0
+    for text in corpus:
+        if legacy_parse_annotation(text) != new_parse_annotation(text) or legacy_parse_text(text) != parse_text(text):
+            mismatches += 1
+    print(f"{len(corpus)} annotations, {mismatches} mismatches")
+
+    legacy_time = time_function(legacy_parse_annotation, corpus, args.repeat)
+    new_time = time_function(new_parse_annotation, corpus, args.repeat)
+    print(f"legacy: {legacy_time:.3f}s ({len(corpus) / legacy_time:.0f} annotations/s)")
+    print(f"single-pass: {new_time:.3f}s ({len(corpus) / new_time:.0f} annotations/s)")
+    print(f"speedup: {legacy_time / new_time:.2f}x")
+
+    if mismatches:
+        raise SystemExit(1)
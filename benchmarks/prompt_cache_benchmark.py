@@ -0,0 +1,47 @@
+import time
+import argparse
+
+import torch
+
+from data_construction.image_generate import (
+    PromptEmbeddingCache, generate_images, get_profile, load_generation_profiles, load_pipeline,
+)
+
+
+def time_generation(pipe, prompts, images_per_prompt, profile, prompt_cache=None):
+    """
+    generate images_per_prompt single-image calls per prompt and return the seconds per image
+    """
+    start = time.perf_counter()
+    for prompt in prompts:
+        for image_id in range(images_per_prompt):
+            generate_images(pipe, [prompt], [image_id], profile, prompt_cache=prompt_cache)
+    return (time.perf_counter() - start) / (len(prompts) * images_per_prompt)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the per-image time saved by caching text encoder outputs.")
+    parser.add_argument("--model_id", default="hf-internal-testing/tiny-stable-diffusion-pipe", help="Small pipeline (model id or local folder) to benchmark.")
+    parser.add_argument("--device", default="cpu", help="Device to run on.")
+    parser.add_argument("--num_prompts", type=int, default=4, help="Number of distinct prompts.")
+    parser.add_argument("--images_per_prompt", type=int, default=6, help="Images generated per prompt.")
+    parser.add_argument("--num_inference_steps", type=int, default=2, help="Denoising steps, kept low so that text encoding is visible.")
+    args = parser.parse_args()
+
+    profile = dict(get_profile(load_generation_profiles(), args.model_id), num_inference_steps=args.num_inference_steps)
+    pipe = load_pipeline(args.model_id, device=args.device, torch_dtype=torch.float32)
+    prompts = [f"A photo of object number {i} on a wooden table, natural light" for i in range(args.num_prompts)]
+
+    # warm up both paths once
+    generate_images(pipe, prompts[:1], [0], profile)
+    prompt_cache = PromptEmbeddingCache(pipe, profile, args.device)
+    if not prompt_cache.supported:
+        raise SystemExit(f"{type(pipe).__name__} is not supported by PromptEmbeddingCache")
+
+    uncached = time_generation(pipe, prompts, args.images_per_prompt, profile)
+    cached = time_generation(pipe, prompts, args.images_per_prompt, profile, prompt_cache)
+
+    print(f"pipeline: {type(pipe).__name__}, {args.num_inference_steps} steps on {args.device}")
+    print(f"without cache: {uncached * 1000:.1f} ms/image")
+    print(f"with cache:    {cached * 1000:.1f} ms/image")
+    print(f"saved:         {(uncached - cached) * 1000:.1f} ms/image ({(1 - cached / uncached):.1%})")
@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import random
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(REPO_ROOT, "data_construction", "manual_annotation", "label_studio_server_init.py")
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def list_images(image_root):
+    paths = []
+    for dirpath, _, filenames in os.walk(image_root):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(dirpath, filename), image_root).replace(os.sep, "/"))
+    return sorted(paths)
+
+
+def start_server(image_root, port, production):
+    """
+    start label_studio_server_init.py on the image folder and wait until it answers
+    """
+    command = [sys.executable, SERVER_SCRIPT, "--image_root", image_root, "--port", str(port), "--host", "127.0.0.1"]
+    if production:
+        command.append("--production")
+    server = subprocess.Popen(command, cwd=REPO_ROOT, env=dict(os.environ, PYTHONPATH=REPO_ROOT),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/images/", timeout=1)
+        except urllib.error.HTTPError:
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise SystemExit("Server did not start")
+
+
+def fetch(url, etag=None):
+    """
+    GET a url and return (latency in seconds, status, bytes received, ETag)
+    """
+    headers = {"If-None-Match": etag} if etag else {}
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=30) as response:
+            body = response.read()
+            status, received, etag = response.status, len(body), response.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        status, received = e.code, 0
+    return time.perf_counter() - start, status, received, etag
+
+
+def run_load_test(base_url, paths, concurrency, num_requests, revalidate, seed=0):
+    """
+    request random images with `concurrency` threads; with revalidate, every request after the first one of a
+    path sends If-None-Match like a browser revalidating its cache
+    """
+    rng = random.Random(seed)
+    urls = [f"{base_url}/images/{rng.choice(paths)}" for _ in range(num_requests)]
+    etags = {}
+
+    def request_url(url):
+        latency, status, received, etag = fetch(url, etags.get(url) if revalidate else None)
+        if etag:
+            etags[url] = etag
+        return latency, status, received
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(request_url, urls))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _, _ in results])
+    return {
+        "requests": len(results),
+        "requests_per_second": len(results) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "megabytes": sum(received for _, _, received in results) / 1024 ** 2,
+        "not_modified": sum(status == 304 for _, status, _ in results),
+        "errors": sum(status >= 400 for _, status, _ in results),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Label Studio image server with concurrent requests.")
+    parser.add_argument("--image_root", required=True, help="Local image folder, its images are requested under /images/.")
+    parser.add_argument("--url", default=None, help="Base url of a running server serving --image_root (a server is started if not given).")
+    parser.add_argument("--port", type=int, default=9191, help="Port of the started server.")
+    parser.add_argument("--dev", action="store_true", help="Start the server without --production, for comparison.")
+    parser.add_argument("--concurrency", type=int, default=12, help="Number of concurrent clients, e.g. one per annotator.")
+    parser.add_argument("--num_requests", type=int, default=2000, help="Total number of requests.")
+    parser.add_argument("--revalidate", action="store_true", help="Send If-None-Match for images requested before.")
+    args = parser.parse_args()
+
+    paths = list_images(args.image_root)
+    if not paths:
+        raise SystemExit(f"No images found in {args.image_root}")
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        server = start_server(os.path.abspath(args.image_root), args.port, production=not args.dev)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        stats = run_load_test(base_url.rstrip("/"), paths, args.concurrency, args.num_requests, args.revalidate)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f"{stats['requests']} requests over {len(paths)} images with {args.concurrency} clients")
+    print(f"throughput: {stats['requests_per_second']:.1f} requests/s, {stats['megabytes']:.1f} MB received")
+    print(f"latency:    p50 {stats['p50_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms")
+    print(f"responses:  {stats['not_modified']} not modified, {stats['errors']} errors")
+    if stats["errors"]:
+        raise SystemExit(1)
@@ -0,0 +1,198 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+
+from PIL import Image
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_SERVER = os.path.join(REPO_ROOT, "benchmarks", "mock_openai_server.py")
+FAKE_ANNOTATION = os.path.join(REPO_ROOT, "data_construction", "fake_annotation")
+REAL_ANNOTATION = os.path.join(REPO_ROOT, "data_construction", "real_annotation")
+STAGES = ["low_level", "high_level", "high_level_refine", "combine", "real", "real_combine", "eval_gpt_4o"]
+RESULT_FIELDS = ["stage", "items", "outputs", "seconds", "images_per_second", "requests", "retries", "p50_latency_ms", "p95_latency_ms", "returncode"]
+
+POINTS = "\n".join(f"<begin_of_point>\n**Error {i}**: description of error {i}.\n<end_of_point>" for i in range(1, 4))
+EVAL_ANNOTATION = f"<begin_of_high_level_errors>\n{POINTS}\n<end_of_high_level_errors>\n\n**Conclusion**: \\boxed{{AI-generated}}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run every annotation stage against the mock OpenAI server and report its throughput.")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="Stages to run, in pipeline order.")
+    parser.add_argument("--num_fake", type=int, default=32, help="Number of generated images, split over two model folders.")
+    parser.add_argument("--num_real", type=int, default=32, help="Number of real images.")
+    parser.add_argument("--num_eval", type=int, default=4, help="Number of samples of the gpt_4o metric, each one costs 9 requests.")
+    parser.add_argument("--max_workers", type=int, default=8, help="--max_workers of every stage.")
+    parser.add_argument("--pack_size", type=int, default=1, help="--pack_size of the low-level stage.")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the mock server.")
+    parser.add_argument("--latency", default="lognormal:300:0.4", help="Latency distribution of the mock server.")
+    parser.add_argument("--per_image_ms", type=float, default=100, help="Extra latency per attached image.")
+    parser.add_argument("--error_rate_429", type=float, default=0.02, help="Fraction of requests answered with 429.")
+    parser.add_argument("--error_rate_500", type=float, default=0.01, help="Fraction of requests answered with 500.")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute of the mock server (0 for no limit).")
+    parser.add_argument("--replay", default=None, help="JSONL file of recorded responses served by the mock server.")
+    parser.add_argument("--workspace", default=None, help="Folder for the images and annotations (default: a temporary folder).")
+    parser.add_argument("--output", default=None, help="Path to the result table (.csv or .json).")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of every stage.")
+    return parser.parse_args()
+
+
+def start_mock_server(args):
+    """
+    start mock_openai_server.py and wait until it answers
+    """
+    command = [sys.executable, MOCK_SERVER, "--port", str(args.port), "--latency", args.latency,
+               "--per_image_ms", str(args.per_image_ms), "--error_rate_429", str(args.error_rate_429),
+               "--error_rate_500", str(args.error_rate_500), "--rpm", str(args.rpm)]
+    if args.replay:
+        command += ["--replay", args.replay]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{args.port}/stats", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise SystemExit("Mock server did not start")
+
+
+def server_call(port, path, post=False):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=b"{}" if post else None)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def make_workspace(workspace, num_fake, num_real, num_eval):
+    """
+    small images with distinct colors, plus the annotation file of the gpt_4o metric
+    """
+    for i in range(num_fake):
+        folder = os.path.join(workspace, "generated_images", f"model_{i % 2}")
+        os.makedirs(folder, exist_ok=True)
+        Image.new("RGB", (256, 256), (i * 7 % 256, i * 13 % 256, 128)).save(os.path.join(folder, f"{i:05d}.png"))
+
+    os.makedirs(os.path.join(workspace, "real_images"), exist_ok=True)
+    for i in range(num_real):
+        Image.new("RGB", (256, 256), (128, i * 7 % 256, i * 13 % 256)).save(os.path.join(workspace, "real_images", f"{i:05d}.jpg"))
+
+    with open(os.path.join(workspace, "eval_annotations.jsonl"), "w", encoding="utf-8") as f:
+        for i in range(num_eval):
+            f.write(json.dumps({"image_path": f"{i:05d}.png", "ground_truth": EVAL_ANNOTATION,
+                                "generated": EVAL_ANNOTATION, "label": "AI-generated"}) + "\n")
+
+
+def stage_command(stage, workspace, args):
+    """
+    (command, number of input items, folder or file of the outputs) of a stage
+    """
+    path = lambda name: os.path.join(workspace, name)
+    workers = ["--max_workers", str(args.max_workers)]
+    commands = {
+        "low_level": ([os.path.join(FAKE_ANNOTATION, "annotation_low_level.py"), "--input_folder", path("generated_images"),
+                       "--output_folder", path("low_level"), "--pack_size", str(args.pack_size)] + workers, args.num_fake, path("low_level")),
+        "high_level": ([os.path.join(FAKE_ANNOTATION, "annotation_high_level.py"), "--input_folder", path("generated_images"),
+                        "--output_folder", path("high_level_norefined")] + workers, args.num_fake, path("high_level_norefined")),
+        "high_level_refine": ([os.path.join(FAKE_ANNOTATION, "annotation_high_level_refine.py"), "--image_root", path("generated_images"),
+                               "--annotation_root", path("high_level_norefined"), "--output_root", path("high_level_refined")] + workers,
+                              args.num_fake, path("high_level_refined")),
+        "combine": ([os.path.join(FAKE_ANNOTATION, "annotation_combine.py"), "--input_folder", path("generated_images"),
+                     "--low_level_folder", path("low_level"), "--high_level_folder", path("high_level_refined"),
+                     "--output_folder", path("final")] + workers, args.num_fake, path("final")),
+        "real": ([os.path.join(REAL_ANNOTATION, "annotation_real.py"), "--input_folder", path("real_images"),
+                  "--output_folder", path("real_high_level")] + workers, args.num_real, path("real_high_level")),
+        # the local structurer makes no requests, so the API path is benchmarked
+        "real_combine": ([os.path.join(REAL_ANNOTATION, "annotation_real_combine.py"), "--input_folder", path("real_images"),
+                          "--high_level_folder", path("real_high_level"), "--output_folder", path("real_final"),
+                          "--structurer", "llm"] + workers, args.num_real, path("real_final")),
+        "eval_gpt_4o": ([os.path.join(REPO_ROOT, "eval", "score_compute.py"), "--annotation_file", path("eval_annotations.jsonl"),
+                         "--metrics", "gpt_4o", "--output_file", path("eval_result.txt"), "--flush_every", "0"],
+                        args.num_eval, path("eval_result.txt")),
+    }
+    command, num_items, output = commands[stage]
+    return [sys.executable] + command, num_items, output
+
+
+def count_outputs(output, num_items):
+    if os.path.isfile(output):
+        return num_items
+    return sum(filename.endswith(".txt") for _, _, filenames in os.walk(output) for filename in filenames)
+
+
+def run_stage(stage, workspace, args, env):
+    command, num_items, output = stage_command(stage, workspace, args)
+    server_call(args.port, "/stats/reset", post=True)
+
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=workspace, env=env, stdout=None if args.verbose else subprocess.DEVNULL,
+                               stderr=None if args.verbose else subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+
+    stats = server_call(args.port, "/stats")
+    # every 429 and 500 is retried, by the OpenAI client or by utils.gpt4o.gpt4o_response
+    retries = sum(count for status, count in stats["status_counts"].items() if status != "200")
+    outputs = count_outputs(output, num_items)
+    return {
+        "stage": stage,
+        "items": num_items,
+        "outputs": outputs,
+        "seconds": round(elapsed, 3),
+        "images_per_second": round(outputs / elapsed, 3),
+        "requests": stats["requests"],
+        "retries": retries,
+        "p50_latency_ms": round(stats["p50_latency"] * 1000, 1),
+        "p95_latency_ms": round(stats["p95_latency"] * 1000, 1),
+        "returncode": completed.returncode,
+    }
+
+
+def write_results(results, output):
+    if output.endswith(".json"):
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    else:
+        with open(output, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    temp_dir = None
+    workspace = args.workspace
+    if workspace is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="stage_benchmark_")
+        workspace = temp_dir.name
+    workspace = os.path.abspath(workspace)
+    make_workspace(workspace, args.num_fake, args.num_real, args.num_eval)
+
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, OPENAI_BASE_URL=f"http://127.0.0.1:{args.port}/v1")
+    server = start_mock_server(args)
+    results = []
+    try:
+        for stage in [stage for stage in STAGES if stage in args.stages]:
+            result = run_stage(stage, workspace, args, env)
+            results.append(result)
+            print(f"{stage:<18} {result['outputs']:>4}/{result['items']:<4} outputs  {result['images_per_second']:>7.2f} images/s  "
+                  f"{result['requests']:>5} requests  {result['retries']:>4} retries  p95 {result['p95_latency_ms']:>7.1f} ms"
+                  + (f"  (exit code {result['returncode']})" if result["returncode"] else ""))
+    finally:
+        server.terminate()
+        server.wait()
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    if args.output:
+        write_results(results, args.output)
+        print(f"Results saved to {args.output}")
+    if any(result["returncode"] for result in results):
+        raise SystemExit(1)
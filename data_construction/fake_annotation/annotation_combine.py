@@ -1,6 +1,11 @@
 import os
+import json
+import time
+import random
+import difflib
 import argparse
 from utils.gpt4o import gpt4o_response
+from utils.utils import filter_skipped, parse_annotation
 from tqdm import tqdm
 import concurrent.futures
 
@@ -47,34 +52,24 @@ Use this structure to process and merge the provided annotations while ensuring
 
 
 
-def process_image(image_path, low_level_folder, high_level_folder, output_folder, prompt_template):
+def build_combine_prompt(image_path, low_level_folder, high_level_folder, prompt_template):
     """
-    Process a single image, call the GPT-4 API, and save the result to a file.
+    Fill the prompt template with the low-level and high-level annotations of an image, None if one is missing.
     """
     filename = os.path.basename(image_path)
     output_filename = os.path.splitext(filename)[0] + ".txt"
     subfolder = os.path.basename(os.path.dirname(image_path))
 
-    current_folder = os.path.join(output_folder, subfolder)
-    if not os.path.exists(current_folder):
-        os.makedirs(current_folder, exist_ok=True)
-
-    output_path = os.path.join(current_folder, output_filename)
     low_level_path = os.path.join(low_level_folder, subfolder, output_filename)
     high_level_path = os.path.join(high_level_folder, subfolder, output_filename)
 
-    # Skip if the output file already exists
-    if os.path.exists(output_path):
-        print(f"Skipping {output_path}, output file already exists.")
-        return  # Skip further processing
-    
     if not os.path.exists(low_level_path):
         print(f"Missing low-level annotation: {low_level_path}, skipping...")
-        return
+        return None
     
     if not os.path.exists(high_level_path):
         print(f"Missing high-level annotation: {high_level_path}, skipping...")
-        return
+        return None
     
     with open(low_level_path, "r") as f:
         low_level_annotation = f.read()
@@ -82,11 +77,44 @@ def process_image(image_path, low_level_folder, high_level_folder, output_folder
     with open(high_level_path, "r") as f:
         high_level_annotation = f.read()
 
-    prompt = prompt_template.format(low_level_annotation=low_level_annotation, high_level_annotation=high_level_annotation)
+    return prompt_template.format(low_level_annotation=low_level_annotation, high_level_annotation=high_level_annotation)
+
+
+def combine_response(prompt, image_path, no_image=False, model_version=None):
+    """
+    Merge the annotations with the image attached, or from the texts alone with no_image. model_version
+    overrides the default model, e.g. a cheaper one for the text-only merge.
+    """
+    kwargs = {"model_version": model_version} if model_version else {}
+    return gpt4o_response(prompt, None if no_image else image_path, **kwargs)
+
+
+def process_image(image_path, low_level_folder, high_level_folder, output_folder, prompt_template, no_image=False, model_version=None):
+    """
+    Process a single image, call the GPT-4 API, and save the result to a file.
+    """
+    filename = os.path.basename(image_path)
+    output_filename = os.path.splitext(filename)[0] + ".txt"
+    subfolder = os.path.basename(os.path.dirname(image_path))
+
+    current_folder = os.path.join(output_folder, subfolder)
+    if not os.path.exists(current_folder):
+        os.makedirs(current_folder, exist_ok=True)
+
+    output_path = os.path.join(current_folder, output_filename)
+
+    # Skip if the output file already exists
+    if os.path.exists(output_path):
+        print(f"Skipping {output_path}, output file already exists.")
+        return  # Skip further processing
+
+    prompt = build_combine_prompt(image_path, low_level_folder, high_level_folder, prompt_template)
+    if prompt is None:
+        return
 
     # Call the GPT-4 API
     try:
-        response = gpt4o_response(prompt, image_path)
+        response = combine_response(prompt, image_path, no_image, model_version)
 
         # Write the result to the output file
         with open(output_path, "w", encoding="utf-8") as f:
@@ -97,7 +125,92 @@ def process_image(image_path, low_level_folder, high_level_folder, output_folder
     except Exception as e:
         print(f"Error processing {output_path}: {e}")
 
-def process_images_parallel(input_folder, low_level_folder, high_level_folder, output_folder, prompt_template, max_workers=None):
+
+def point_similarity(points, reference_points):
+    """
+    average over reference points of the best difflib ratio with any of the points (1.0 if both are empty)
+    """
+    if not reference_points:
+        return 1.0 if not points else 0.0
+    return sum(
+        max((difflib.SequenceMatcher(None, reference, point).ratio() for point in points), default=0.0)
+        for reference in reference_points
+    ) / len(reference_points)
+
+
+def compare_annotations(text_only, image_conditioned):
+    """
+    compare a text-only merge with the image-conditioned merge of the same image
+    """
+    record, reference = parse_annotation(text_only or ""), parse_annotation(image_conditioned or "")
+    low_level, reference_low_level = parse_annotation(record.low_level or ""), parse_annotation(reference.low_level or "")
+    return {
+        "label_match": record.label == reference.label,
+        "low_level_points": [len(low_level.points), len(reference_low_level.points)],
+        "high_level_points": [len(record.points), len(reference.points)],
+        "low_level_similarity": point_similarity(low_level.points, reference_low_level.points),
+        "high_level_similarity": point_similarity(record.points, reference.points),
+    }
+
+
+def compare_combine_modes(image_paths, low_level_folder, high_level_folder, prompt_template, sample_size, model_version, report_path, max_workers=None, seed=0):
+    """
+    Merge a random sample of images both with the image attached (default model) and from the texts alone
+    (model_version), and write a JSON report comparing the outputs, latencies and payload sizes.
+    """
+    prompts = {}
+    for image_path in image_paths:
+        prompt = build_combine_prompt(image_path, low_level_folder, high_level_folder, prompt_template)
+        if prompt is not None:
+            prompts[image_path] = prompt
+    sample = random.Random(seed).sample(sorted(prompts), min(sample_size, len(prompts)))
+
+    def timed_response(image_path, no_image):
+        start = time.perf_counter()
+        response = combine_response(prompts[image_path], image_path, no_image, model_version if no_image else None)
+        return response, time.perf_counter() - start
+
+    def compare(image_path):
+        image_conditioned, image_latency = timed_response(image_path, no_image=False)
+        text_only, text_latency = timed_response(image_path, no_image=True)
+        return {
+            "image_path": image_path,
+            "image_conditioned": image_conditioned,
+            "text_only": text_only,
+            "image_latency": image_latency,
+            "text_latency": text_latency,
+            # images are sent base64-encoded
+            "image_payload_bytes": os.path.getsize(image_path) * 4 // 3,
+            **compare_annotations(text_only, image_conditioned),
+        }
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        samples = list(tqdm(executor.map(compare, sample), total=len(sample), desc="Comparing combine modes"))
+
+    def mean(key):
+        return sum(sample[key] for sample in samples) / len(samples) if samples else 0.0
+
+    summary = {
+        "num_samples": len(samples),
+        "text_only_model": model_version or "default",
+        "label_agreement": mean("label_match"),
+        "low_level_similarity": mean("low_level_similarity"),
+        "high_level_similarity": mean("high_level_similarity"),
+        "image_latency": mean("image_latency"),
+        "text_latency": mean("text_latency"),
+        "image_payload_bytes": mean("image_payload_bytes"),
+    }
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({"summary": summary, "samples": samples}, f, indent=4, ensure_ascii=False)
+
+    print(f"Comparison of {len(samples)} samples saved to {report_path}")
+    print(f"- label agreement: {summary['label_agreement']:.1%}")
+    print(f"- point similarity: low-level {summary['low_level_similarity']:.3f}, high-level {summary['high_level_similarity']:.3f}")
+    print(f"- latency: {summary['image_latency']:.1f}s with image, {summary['text_latency']:.1f}s text-only")
+    return summary
+
+def process_images_parallel(input_folder, low_level_folder, high_level_folder, output_folder, prompt_template, max_workers=None, skip_list=None, no_image=False, model_version=None,
+                            compare_sample=0, compare_report="combine_comparison.json"):
 
     # Ensure the output folder exists
     if not os.path.exists(output_folder):
@@ -108,9 +221,15 @@ def process_images_parallel(input_folder, low_level_folder, high_level_folder, o
     for subfolder in os.listdir(input_folder):
         current_folder = os.path.join(input_folder, subfolder)
         for filename in os.listdir(current_folder):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
+            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
                 image_paths.append(os.path.join(current_folder, filename))
 
+    image_paths = filter_skipped(image_paths, skip_list)
+
+    if compare_sample:
+        compare_combine_modes(image_paths, low_level_folder, high_level_folder, prompt_template, compare_sample, model_version, compare_report, max_workers)
+        return
+
     # Use a thread pool to process images in parallel
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         list(tqdm(
@@ -118,7 +237,9 @@ def process_images_parallel(input_folder, low_level_folder, high_level_folder, o
             [low_level_folder] * len(image_paths), 
             [high_level_folder] * len(image_paths), 
             [output_folder] * len(image_paths),
-            [prompt_template] * len(image_paths)), 
+            [prompt_template] * len(image_paths),
+            [no_image] * len(image_paths),
+            [model_version] * len(image_paths)), 
             total=len(image_paths), 
             desc="Processing images"
             ))
@@ -130,9 +251,15 @@ def main():
     parser.add_argument("--high_level_folder", default="generated_annotation_high_level_refined", help="Path to the folder where high-level output text files will be saved.")
     parser.add_argument("--output_folder", default="generated_annotation_final", help="Path to the folder where final output text files will be saved.")
     parser.add_argument("--max_workers", type=int, default=4, help="Maximum number of worker threads. (Default: number of CPU cores)")
+    parser.add_argument("--skip_list", default=None, help="File listing image paths to skip, e.g. near-duplicates found by data_construction/image_dedup.py.")
+    parser.add_argument("--no_image", action="store_true", help="Merge the two annotations from their texts alone, without attaching the image.")
+    parser.add_argument("--model_version", default=None, help="Model used for the merge instead of the default one, e.g. a cheaper model with --no_image.")
+    parser.add_argument("--compare_sample", type=int, default=0, help="Instead of annotating, merge this many random images both with the image and text-only (--model_version) and compare the outputs.")
+    parser.add_argument("--compare_report", default="combine_comparison.json", help="Path to the JSON report of --compare_sample.")
     args = parser.parse_args()
 
-    process_images_parallel(args.input_folder, args.low_level_folder, args.high_level_folder, args.output_folder, prompt_template, args.max_workers)
+    process_images_parallel(args.input_folder, args.low_level_folder, args.high_level_folder, args.output_folder, prompt_template, args.max_workers, args.skip_list,
+                            args.no_image, args.model_version, args.compare_sample, args.compare_report)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os
 import argparse
 from utils.gpt4o import gpt4o_response
+from utils.utils import filter_skipped
 from tqdm import tqdm
 import concurrent.futures
 
@@ -89,7 +90,7 @@ def process_image(image_path, output_folder, prompt_template):
     except Exception as e:
         print(f"Error processing {output_path}: {e}")
 
-def process_images_parallel(input_folder, output_folder, prompt_template, max_workers=None):
+def process_images_parallel(input_folder, output_folder, prompt_template, max_workers=None, skip_list=None):
     """
     Process images in parallel from the input folder.
 
@@ -98,6 +99,7 @@ def process_images_parallel(input_folder, output_folder, prompt_template, max_wo
         output_folder: Path to the folder where output text files will be saved.
         prompt_template: Prompt template for analysis.
         max_workers: Maximum number of worker threads. If None, defaults to the number of CPU cores.
+        skip_list: Optional file listing image paths to skip, e.g. near-duplicates.
     """
     # Ensure the output folder exists
     if not os.path.exists(output_folder):
@@ -108,9 +110,11 @@ def process_images_parallel(input_folder, output_folder, prompt_template, max_wo
     for subfolder in os.listdir(input_folder):
         current_folder = os.path.join(input_folder, subfolder)
         for filename in os.listdir(current_folder):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
+            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
                 image_paths.append(os.path.join(current_folder, filename))
 
+    image_paths = filter_skipped(image_paths, skip_list)
+
     # Use a thread pool to process images in parallel
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         list(tqdm(executor.map(process_image, image_paths, [output_folder] * len(image_paths), [prompt_template] * len(image_paths)),
@@ -121,9 +125,10 @@ def main():
     parser.add_argument("--input_folder", default="generated_images", help="Path to the folder containing images.")
     parser.add_argument("--output_folder", default="generated_annotation_high_level_norefined", help="Path to the folder where output text files will be saved.")
     parser.add_argument("--max_workers", type=int, default=4, help="Maximum number of worker threads. (Default: number of CPU cores)")
+    parser.add_argument("--skip_list", default=None, help="File listing image paths to skip, e.g. near-duplicates found by data_construction/image_dedup.py.")
     args = parser.parse_args()
 
-    process_images_parallel(args.input_folder, args.output_folder, prompt_template, args.max_workers)
+    process_images_parallel(args.input_folder, args.output_folder, prompt_template, args.max_workers, args.skip_list)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,11 @@
 import os
-import re
 import argparse
 import json
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor
 
 from utils.gpt4o import gpt4o_response
+from utils.utils import parse_text, load_skip_list
 
 
 refine_prompt = """You have been given an annotated text of a synthesized image. The text follows a structured format, which consists of:  
@@ -49,26 +49,6 @@ Your task is to analyze each **point** individually and assess its validity base
 """
 
 
-def parse_text(text):
-    text = text.strip()
-    
-    sections = re.split(r"<begin_of_point>", text)
-    prefix = sections[0].strip() if sections[0] else None
-    
-    points = []
-    conclusion = None
-    
-    for section in sections[1:]:
-        parts = section.split("<end_of_point>", 1)
-        if len(parts) == 2:
-            points.append(parts[0].strip())
-            conclusion = parts[1].strip() if parts[1] else None
-        else:
-            points.append(parts[0].strip())
-    
-    return prefix, points, conclusion
-
-
 def join_text(prefix, points, conclusion):
     sections = []
     
@@ -156,7 +136,9 @@ def process_single_image(image_path, annotation_path, new_annotation_path):
         f.write(refined_text)
 
 
-def process_fake_annotations(image_root, annotation_root, new_annotation_root, max_workers=None):
+def process_fake_annotations(image_root, annotation_root, new_annotation_root, max_workers=None, skip_list=None):
+
+    skipped = load_skip_list(skip_list)
 
     subfolders = [f.name for f in os.scandir(image_root) if f.is_dir()]
 
@@ -172,6 +154,8 @@ def process_fake_annotations(image_root, annotation_root, new_annotation_root, m
 
             for image_name in os.listdir(image_subfolder):
                 image_path = os.path.join(image_subfolder, image_name)
+                if os.path.abspath(image_path) in skipped:
+                    continue
                 annotation_name = os.path.splitext(image_name)[0] + ".txt"
                 annotation_path = os.path.join(annotation_subfolder, annotation_name)
                 new_annotation_path = os.path.join(new_annotation_subfolder, annotation_name)
@@ -194,6 +178,8 @@ def main():
                         help="Root directory to save processed annotations.")
     parser.add_argument("--max_workers", type=int, default=4,
                         help="Maximum number of worker threads for parallel processing.")
+    parser.add_argument("--skip_list", type=str, default=None,
+                        help="File listing image paths to skip, e.g. near-duplicates found by data_construction/image_dedup.py.")
 
     args = parser.parse_args()
 
@@ -202,7 +188,7 @@ def main():
     print(f"Output root: {args.output_root}")
     print(f"Max workers: {args.max_workers}")
 
-    process_fake_annotations(args.image_root, args.annotation_root, args.output_root, args.max_workers)
+    process_fake_annotations(args.image_root, args.annotation_root, args.output_root, args.max_workers, args.skip_list)
 
 
 if __name__ == "__main__":
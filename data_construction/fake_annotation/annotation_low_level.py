@@ -1,19 +1,19 @@
 import os
 import argparse
 from utils.gpt4o import gpt4o_response
+from utils.utils import filter_skipped, build_packed_prompt, split_packed_response
 from tqdm import tqdm
 import concurrent.futures
 
 # Fixed prompt template
 prompt_template = """This is an AI-generated image, please only list the most obvious low-level errors you observed in this image. Low-level errors are more subtle and relate to fine details, textures, or visual artifacts that may not be immediately obvious without closer inspection. Do not list too many low-level errors."""
 
+MAX_PACKED_TOKENS = 16000 # output token limit of a packed request
 
 
 
-def process_image(image_path, output_folder, prompt_template):
-    """
-    Process a single image, call the GPT-4 API, and save the result to a file.
-    """
+
+def get_output_path(image_path, output_folder):
     filename = os.path.basename(image_path)
     output_filename = os.path.splitext(filename)[0] + ".txt"
     subfolder = os.path.basename(os.path.dirname(image_path))
@@ -22,7 +22,14 @@ def process_image(image_path, output_folder, prompt_template):
     if not os.path.exists(current_folder):
         os.makedirs(current_folder, exist_ok=True)
 
-    output_path = os.path.join(current_folder, output_filename)
+    return os.path.join(current_folder, output_filename)
+
+
+def process_image(image_path, output_folder, prompt_template):
+    """
+    Process a single image, call the GPT-4 API, and save the result to a file.
+    """
+    output_path = get_output_path(image_path, output_folder)
 
     # Skip if the output file already exists
     if os.path.exists(output_path):
@@ -42,7 +49,39 @@ def process_image(image_path, output_folder, prompt_template):
     except Exception as e:
         print(f"Error processing {output_path}: {e}")
 
-def process_images_parallel(input_folder, output_folder, prompt_template, max_workers=None):
+def process_image_pack(image_paths, output_folder, prompt_template):
+    """
+    Annotate several images with one request. Images whose answer is missing or invalid in the packed
+    response fall back to single-image requests.
+
+    Returns the number of requests sent.
+    """
+    image_paths = [path for path in image_paths if not os.path.exists(get_output_path(path, output_folder))]
+    if not image_paths:
+        return 0
+
+    try:
+        response = gpt4o_response(build_packed_prompt(prompt_template, len(image_paths)), image_paths,
+                                  max_tokens=min(2000 * len(image_paths), MAX_PACKED_TOKENS))
+        answers = split_packed_response(response, len(image_paths))
+    except Exception as e:
+        print(f"Error processing packed request of {len(image_paths)} images: {e}")
+        answers = [None] * len(image_paths)
+
+    requests = 1
+    for image_path, answer in zip(image_paths, answers):
+        if answer is None:
+            print(f"No valid answer for {image_path} in packed response, falling back to a single request")
+            process_image(image_path, output_folder, prompt_template)
+            requests += 1
+            continue
+        output_path = get_output_path(image_path, output_folder)
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(answer)
+        print(f"Processed {image_path}, result saved to {output_path}")
+    return requests
+
+def process_images_parallel(input_folder, output_folder, prompt_template, max_workers=None, skip_list=None, pack_size=1):
     """
     Process images in parallel from the input folder.
 
@@ -51,6 +90,8 @@ def process_images_parallel(input_folder, output_folder, prompt_template, max_wo
         output_folder: Path to the folder where output text files will be saved.
         prompt_template: Prompt template for analysis.
         max_workers: Maximum number of worker threads. If None, defaults to the number of CPU cores.
+        skip_list: Optional file listing image paths to skip, e.g. near-duplicates.
+        pack_size: Number of images annotated per request (1 sends one request per image).
     """
     # Ensure the output folder exists
     if not os.path.exists(output_folder):
@@ -61,9 +102,20 @@ def process_images_parallel(input_folder, output_folder, prompt_template, max_wo
     for subfolder in os.listdir(input_folder):
         current_folder = os.path.join(input_folder, subfolder)
         for filename in os.listdir(current_folder):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
+            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
                 image_paths.append(os.path.join(current_folder, filename))
 
+    image_paths = filter_skipped(image_paths, skip_list)
+
+    if pack_size > 1:
+        todo = [path for path in image_paths if not os.path.exists(get_output_path(path, output_folder))]
+        packs = [todo[i:i + pack_size] for i in range(0, len(todo), pack_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            requests = sum(tqdm(executor.map(process_image_pack, packs, [output_folder] * len(packs), [prompt_template] * len(packs)),
+                                total=len(packs), desc="Processing image packs"))
+        print(f"{requests} requests sent for {len(todo)} images ({len(image_paths) - len(todo)} already annotated)")
+        return
+
     # Use a thread pool to process images in parallel
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         list(tqdm(executor.map(process_image, image_paths, [output_folder] * len(image_paths), [prompt_template] * len(image_paths)),
@@ -74,9 +126,11 @@ def main():
     parser.add_argument("--input_folder", default="generated_images", help="Path to the folder containing images.")
     parser.add_argument("--output_folder", default="generated_annotation_low_level", help="Path to the folder where output text files will be saved.")
     parser.add_argument("--max_workers", type=int, default=4, help="Maximum number of worker threads. (Default: number of CPU cores)")
+    parser.add_argument("--skip_list", default=None, help="File listing image paths to skip, e.g. near-duplicates found by data_construction/image_dedup.py.")
+    parser.add_argument("--pack_size", type=int, default=1, help="Number of images annotated in one request, images missing from a packed answer are retried alone.")
     args = parser.parse_args()
 
-    process_images_parallel(args.input_folder, args.output_folder, prompt_template, args.max_workers)
+    process_images_parallel(args.input_folder, args.output_folder, prompt_template, args.max_workers, args.skip_list, args.pack_size)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
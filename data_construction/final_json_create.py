@@ -4,6 +4,8 @@ import random
 from tqdm import tqdm
 import argparse
 
+from utils.utils import load_skip_list
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Prepare dataset for image authenticity classification")
@@ -26,6 +28,8 @@ def parse_args():
     parser.add_argument("--output_combined_json", type=str,
                         default="final_train_data.json",
                         help="Output path for combined JSON file WHEN NOT SPLITING")
+    parser.add_argument("--skip_list", type=str, default=None,
+                        help="File listing image paths to leave out, e.g. near-duplicates found by data_construction/image_dedup.py")
     return parser.parse_args()
 
 
@@ -43,13 +47,15 @@ questions = [
 ]
 
 
-def process_images_and_annotations(image_root, annotation_root, label, data):
+def process_images_and_annotations(image_root, annotation_root, label, data, skipped=frozenset()):
     image_name_roots = os.listdir(image_root)
     for image_name_root in tqdm(image_name_roots, desc=f"Processing {'real' if label == 0 else 'fake'} images"):
         if label == 1:
             cur_image_root = os.path.join(image_root, image_name_root)
             for image_name in os.listdir(cur_image_root):
                 image_path = os.path.join(cur_image_root, image_name)
+                if os.path.abspath(image_path) in skipped:
+                    continue
                 annotation_name = os.path.splitext(image_name)[0] + ".txt"
                 annotation_path = os.path.join(annotation_root, image_name_root, annotation_name)
 
@@ -73,6 +79,8 @@ def process_images_and_annotations(image_root, annotation_root, label, data):
                 data.append(entry)
         elif label == 0:
             image_path = os.path.join(image_root, image_name_root)
+            if os.path.abspath(image_path) in skipped:
+                continue
             annotation_name = os.path.splitext(image_name_root)[0] + ".txt"
             annotation_path = os.path.join(annotation_root, annotation_name)
 
@@ -102,8 +110,9 @@ def process_images_and_annotations(image_root, annotation_root, label, data):
 
 def main(args):
     data = []
-    process_images_and_annotations(args.fake_image_root, args.fake_annotation_root, label=1, data=data)
-    process_images_and_annotations(args.real_image_root, args.real_annotation_root, label=0, data=data)
+    skipped = load_skip_list(args.skip_list)
+    process_images_and_annotations(args.fake_image_root, args.fake_annotation_root, label=1, data=data, skipped=skipped)
+    process_images_and_annotations(args.real_image_root, args.real_annotation_root, label=0, data=data, skipped=skipped)
 
     real_data = [item for item in data if item["label"] == 0]
     fake_data = [item for item in data if item["label"] == 1]
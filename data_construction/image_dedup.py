@@ -0,0 +1,263 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+HASH_SIZE = 8 # 8x8 = 64-bit hashes
+PHASH_SIZE = 32 # images are reduced to 32x32 before the DCT of pHash
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Find near-duplicate images with perceptual hashes and write a skip list for the annotation scripts")
+    parser.add_argument("--image_roots", type=str, nargs="+", default=["generated_images", "real_images"],
+                        help="Image folders (searched recursively), duplicates are searched within each folder")
+    parser.add_argument("--index_file", type=str, default="image_hash_index.jsonl",
+                        help="JSONL index of the hashes, reused for unchanged images on the next run")
+    parser.add_argument("--skip_list", type=str, default="dedup_skip_list.txt",
+                        help="Output file with the paths of the duplicates to skip, one per line")
+    parser.add_argument("--report_file", type=str, default="dedup_report.jsonl",
+                        help="Output JSONL with every duplicate, the image it duplicates and their distances")
+    parser.add_argument("--phash_threshold", type=int, default=6,
+                        help="Maximum pHash Hamming distance (out of 64 bits) of near-duplicates")
+    parser.add_argument("--dhash_threshold", type=int, default=10,
+                        help="Maximum dHash Hamming distance confirming a pHash match")
+    parser.add_argument("--max_workers", type=int, default=None,
+                        help="Number of hashing processes (default: number of CPU cores)")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="Images hashed per task, the DCTs of a batch are computed at once")
+    return parser.parse_args()
+
+
+def dct_matrix(n):
+    """
+    orthonormal DCT-II matrix, the 2D DCT of X is D @ X @ D.T
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_MATRIX = dct_matrix(PHASH_SIZE)
+BIT_WEIGHTS = 1 << np.arange(HASH_SIZE * HASH_SIZE - 1, -1, -1, dtype=np.uint64)
+
+
+def pack_bits(bits):
+    """
+    (batch, 64) boolean array -> list of 64-bit ints
+    """
+    return [int(value) for value in (bits.astype(np.uint64) * BIT_WEIGHTS).sum(axis=1, dtype=np.uint64)]
+
+
+def phash_batch(pixels):
+    """
+    pHash of a (batch, 32, 32) grayscale array: low frequencies of the 2D DCT compared to their median
+    """
+    coefficients = np.einsum("ij,bjk,lk->bil", DCT_MATRIX, pixels, DCT_MATRIX)[:, :HASH_SIZE, :HASH_SIZE]
+    flat = coefficients.reshape(len(pixels), -1)
+    # the DC coefficient only encodes brightness and is left out of the median
+    median = np.median(flat[:, 1:], axis=1, keepdims=True)
+    return pack_bits(flat > median)
+
+
+def dhash_batch(pixels):
+    """
+    dHash of a (batch, 8, 9) grayscale array: sign of the horizontal gradient
+    """
+    return pack_bits((pixels[:, :, 1:] > pixels[:, :, :-1]).reshape(len(pixels), -1))
+
+
+def hash_images(paths):
+    """
+    compute (path, phash, dhash, error) of a batch of images
+    """
+    from PIL import Image
+
+    loaded, results = [], []
+    phash_pixels, dhash_pixels = [], []
+    for path in paths:
+        try:
+            with Image.open(path) as image:
+                image.draft("L", (PHASH_SIZE, PHASH_SIZE))
+                gray = image.convert("L")
+                phash_pixels.append(np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float64))
+                dhash_pixels.append(np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16))
+            loaded.append(path)
+        except Exception as e:
+            results.append((path, None, None, f"{type(e).__name__}: {e}"))
+
+    if loaded:
+        phashes = phash_batch(np.stack(phash_pixels))
+        dhashes = dhash_batch(np.stack(dhash_pixels))
+        results.extend((path, phash, dhash, None) for path, phash, dhash in zip(loaded, phashes, dhashes))
+    return results
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with the Hamming distance. A search with radius r only visits
+    children whose edge distance is within r of the query distance (triangle inequality).
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, item, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, item, {})
+                return
+            node = child
+
+    def search(self, value, radius):
+        """
+        list of (distance, item) of all values within radius, closest first
+        """
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                matches.append((distance, node[1]))
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+
+def list_images(image_root):
+    paths = []
+    for dirpath, _, filenames in os.walk(image_root):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.abspath(os.path.join(dirpath, filename)))
+    return sorted(paths)
+
+
+def load_index(index_file):
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                index[record["path"]] = record
+    return index
+
+
+def update_index(paths, index, max_workers=None, batch_size=64):
+    """
+    hash the images that are new or changed since they were indexed, in a process pool
+    """
+    signatures = {}
+    todo = []
+    for path in paths:
+        stat = os.stat(path)
+        signatures[path] = [stat.st_mtime_ns, stat.st_size]
+        record = index.get(path)
+        if record is None or record["signature"] != signatures[path]:
+            todo.append(path)
+
+    print(f"{len(paths) - len(todo)} images already indexed, {len(todo)} to hash")
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for results in tqdm(executor.map(hash_images, batches), total=len(batches), desc="Hashing images"):
+            for path, phash, dhash, error in results:
+                if error:
+                    print(f"Failed to hash {path}: {error}")
+                    index.pop(path, None)
+                    continue
+                index[path] = {"path": path, "signature": signatures[path], "phash": phash, "dhash": dhash}
+
+
+def prune_index(index, image_root, paths):
+    """
+    drop the index entries of images under image_root that were deleted since they were indexed
+    """
+    root = os.path.join(os.path.abspath(image_root), "")
+    current = set(paths)
+    stale = [path for path in index if path.startswith(root) and path not in current]
+    for path in stale:
+        del index[path]
+    return len(stale)
+
+
+def write_index(index_file, index):
+    tmp_path = index_file + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in index.values():
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, index_file)
+
+
+def find_duplicates(paths, index, phash_threshold, dhash_threshold):
+    """
+    Keep the first image (in path order) of every group of near-duplicates. An image is a duplicate if a kept
+    image lies within phash_threshold in pHash and within dhash_threshold in dHash.
+
+    :return: list of (duplicate path, kept path, phash distance, dhash distance)
+    """
+    tree = BKTree()
+    duplicates = []
+    for path in paths:
+        record = index.get(path)
+        if record is None:
+            continue
+        for distance, kept in tree.search(record["phash"], phash_threshold):
+            dhash_distance = hamming(record["dhash"], index[kept]["dhash"])
+            if dhash_distance <= dhash_threshold:
+                duplicates.append((path, kept, distance, dhash_distance))
+                break
+        else:
+            tree.add(record["phash"], path)
+    return duplicates
+
+
+def main(args):
+    index = load_index(args.index_file)
+    all_duplicates = []
+    for image_root in args.image_roots:
+        if not os.path.isdir(image_root):
+            print(f"Skipping missing folder {image_root}")
+            continue
+        paths = list_images(image_root)
+        num_stale = prune_index(index, image_root, paths)
+        if num_stale:
+            print(f"{image_root}: dropped {num_stale} deleted images from the index")
+        update_index(paths, index, args.max_workers, args.batch_size)
+        duplicates = find_duplicates(paths, index, args.phash_threshold, args.dhash_threshold)
+        print(f"{image_root}: {len(duplicates)} near-duplicates among {len(paths)} images")
+        all_duplicates.extend(duplicates)
+
+    write_index(args.index_file, index)
+
+    with open(args.skip_list, "w", encoding="utf-8") as f:
+        f.write("# near-duplicate images written by data_construction/image_dedup.py\n")
+        for path, _, _, _ in all_duplicates:
+            f.write(path + "\n")
+    with open(args.report_file, "w", encoding="utf-8") as f:
+        for path, kept, distance, dhash_distance in all_duplicates:
+            f.write(json.dumps({"path": path, "duplicate_of": kept, "phash_distance": distance, "dhash_distance": dhash_distance}) + "\n")
+
+    print(f"Skip list of {len(all_duplicates)} images saved to {args.skip_list}, details in {args.report_file}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
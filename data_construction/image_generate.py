@@ -1,15 +1,34 @@
 import os
+import diffusers
 from diffusers import AutoPipelineForText2Image
 import torch
 from tqdm import tqdm
 
+import csv
+import sys
+import json
+import hashlib
 import argparse
+import itertools
 import gc
-from concurrent.futures import ThreadPoolExecutor,  ProcessPoolExecutor
+import time
+import resource
+import tempfile
+import queue
+import threading
 import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 SAVED_MODEL_ROOT = "./models" # cached dir for downloaded pretrained weights
 NEGATIVE_PROMPTS = "cartoon, unreal, CGI, 3D, fantasy, neon, blurry" # negative prompts for diffusion model generation
+MEMORY_OPTIONS = ["offload", "attention_slicing", "vae_slicing", "vae_tiling", "channels_last", "sdpa"] # memory-saving execution options
+PROFILE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generation_profiles.json") # per-model generation settings
 
 
 # models used for image generation, more models can be found at https://huggingface.co/models?pipeline_tag=text-to-image
@@ -41,89 +60,974 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Image generate Pipeline')
     parser.add_argument('--save_image_root', type=str, default='./generated_images', help='image root for saving')
     parser.add_argument('--images_per_cat', type=int, default=6, help='images per category')
-    parser.add_argument('--max_workers', type=int, default=4, help='')
+    parser.add_argument('--max_workers', type=int, default=4, help='maximum number of worker processes, each one owns a single device')
+    parser.add_argument('--devices', type=str, nargs='*', default=None, help='devices for the worker processes, e.g. cuda:0 cuda:1 or cpu (default: all cuda devices, cpu if none)')
+    parser.add_argument('--model_ids', type=str, nargs='*', default=None, help='model ids or local pipeline paths to use instead of the predefined model_ids')
+    parser.add_argument('--batch_size', type=int, default=None, help='images per pipeline call for all models (default: batch_size of the model profile, else probed from device memory)')
+    parser.add_argument('--prompt_cache_size', type=int, default=64, help='number of prompts whose text encoder outputs are cached per model (0 disables the cache)')
+    parser.add_argument('--prefetch_memory_gb', type=float, default=16, help='largest weight size (per worker) of the next model that is prefetched into CPU memory while the current model generates (0 disables prefetching)')
+    parser.add_argument('--image_format', type=str, default='png', choices=['png', 'webp'], help='format of saved images, webp is lossless')
+    parser.add_argument('--compress_level', type=int, default=6, help='PNG compression level (0-9), lower is faster and larger')
+    parser.add_argument('--save_threads', type=int, default=2, help='threads per worker encoding and writing images in the background')
+    parser.add_argument('--max_pending_saves', type=int, default=16, help='images per worker waiting to be written before generation blocks')
+    parser.add_argument('--offload', type=str, default=None, choices=['none', 'model', 'sequential'], help='CPU offload mode (default: offload of the model profile)')
+    parser.add_argument('--attention_slicing', action=argparse.BooleanOptionalAction, default=None, help='compute attention in slices')
+    parser.add_argument('--vae_slicing', action=argparse.BooleanOptionalAction, default=None, help='decode latents one image at a time')
+    parser.add_argument('--vae_tiling', action=argparse.BooleanOptionalAction, default=None, help='decode latents in tiles')
+    parser.add_argument('--channels_last', action=argparse.BooleanOptionalAction, default=None, help='use channels-last memory format for UNet and VAE')
+    parser.add_argument('--sdpa', action=argparse.BooleanOptionalAction, default=None, help='use scaled dot product attention processors for the UNet')
+    parser.add_argument('--report_file', type=str, default=None, help='JSONL file receiving per-model load/generate times, images/s and peak memory of every worker')
+    parser.add_argument('--seed', type=int, default=0, help='base seed, the seed of every image is derived from it and the image id')
+    parser.add_argument('--profile_file', type=str, default=PROFILE_FILE, help='JSON or YAML file with per-model generation profiles')
+    parser.add_argument('--max_batch_size', type=int, default=8, help='upper bound for the probed batch size')
+    parser.add_argument('--prompt_file', type=str, default=None, help='TXT (one prompt per line) or JSONL (records with "prompt" and optional "id") file read lazily instead of the predefined prompts')
+    parser.add_argument('--shard_index', type=int, default=0, help='index of the shard of (model, prompt, image) jobs generated by this host')
+    parser.add_argument('--num_shards', type=int, default=1, help='number of hosts splitting the jobs, each one runs with its own --shard_index')
+    parser.add_argument('--merge_manifests', action='store_true', help='merge the shard manifests in --save_image_root into manifest.jsonl and exit')
     return parser.parse_args()
 
 
-def load_pipeline(model_id, model_cls=None, device="cuda"):
+def load_generation_profiles(profile_file=PROFILE_FILE):
+    """
+    Load per-model generation profiles. Every model entry is merged over the "default" entry.
+    """
+    with open(profile_file, "r", encoding="utf-8") as f:
+        if profile_file.endswith((".yaml", ".yml")):
+            import yaml
+            profiles = yaml.safe_load(f)
+        else:
+            profiles = json.load(f)
+
+    default = profiles.get("default", {})
+    return {model_id: {**default, **profile} for model_id, profile in profiles.items()}
+
+
+def get_profile(profiles, model_id):
+    # local pipeline folders are matched by their folder name
+    return profiles.get(model_id) or profiles.get(os.path.basename(model_id.rstrip("/"))) or profiles["default"]
+
+
+def derive_seed(prompt_id, image_id, base_seed=0):
+    """
+    deterministic seed of an image, derived from its id so that reruns regenerate identical images
+    """
+    digest = hashlib.sha256(f"{base_seed}:{prompt_id}_{image_id}".encode()).digest()
+    return int.from_bytes(digest[:4], "little")
+
+
+def iter_prompts(prompt_file=None):
+    """
+    Lazily yield (prompt_id, prompt) pairs from a TXT file (one prompt per line), a JSONL file (records with a
+    "prompt" and an optional "id" field) or the predefined prompts when no file is given. Prompt ids of TXT files
+    and of JSONL records without "id" are their index among the non-empty lines.
+    """
+    if prompt_file is None:
+        yield from enumerate(prompts)
+        return
+
+    is_jsonl = prompt_file.endswith(".jsonl")
+    with open(prompt_file, "r", encoding="utf-8") as f:
+        index = 0
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if is_jsonl:
+                record = json.loads(line)
+                yield record.get("id", index), record["prompt"]
+            else:
+                yield index, line
+            index += 1
+
+
+def shard_of(model_id, prompt_id, image_id, num_shards):
+    """
+    deterministic shard of an image, hashed from its key so that every host computes the same split
+    """
+    if num_shards == 1:
+        return 0
+    digest = hashlib.sha256(f"{model_id}/{prompt_id}_{image_id}".encode()).digest()
+    return int.from_bytes(digest[:8], "little") % num_shards
+
+
+def iter_shard_images(model_id, prompt_file, images_per_cat, save_image_root, base_seed=0, image_format="png",
+                      shard_index=0, num_shards=1):
+    """
+    Yield (prompt_id, image_id, prompt, seed, save_path) of every image of one model that belongs to the shard.
+    """
+    save_root = os.path.join(save_image_root, os.path.basename(model_id.rstrip("/")))
+    for prompt_id, prompt in iter_prompts(prompt_file):
+        for image_id in range(images_per_cat):
+            if shard_of(model_id, prompt_id, image_id, num_shards) == shard_index:
+                seed = derive_seed(prompt_id, image_id, base_seed)
+                save_path = os.path.join(save_root, f"{prompt_id}_{image_id}.{image_format}")
+                yield prompt_id, image_id, prompt, seed, save_path
+
+
+def iter_model_jobs(model_id, prompt_file, images_per_cat, save_image_root, base_seed=0, image_format="png",
+                    shard_index=0, num_shards=1):
+    """
+    Lazily yield the (model_id, prompt, seed, save_path) jobs of the images of one model in the shard that do
+    not exist yet.
+    """
+    save_root = os.path.join(save_image_root, os.path.basename(model_id.rstrip("/")))
+    existing = set(os.listdir(save_root)) if os.path.isdir(save_root) else set()
+
+    images = iter_shard_images(model_id, prompt_file, images_per_cat, save_image_root, base_seed, image_format, shard_index, num_shards)
+    for _, _, prompt, seed, save_path in images:
+        if os.path.basename(save_path) not in existing:
+            yield model_id, prompt, seed, save_path
+
+
+def plan_jobs(model_ids, prompt_file, images_per_cat, save_image_root, base_seed=0, image_format="png",
+              shard_index=0, num_shards=1):
+    """
+    Count the missing images of every model in the shard without keeping the jobs in memory. Models without
+    missing images are left out, so they are never loaded.
+
+    :return: dict of model_id -> number of missing images, in generation order
+    """
+    plan = {}
+    for model_id in model_ids:
+        num_missing = sum(1 for _ in iter_model_jobs(model_id, prompt_file, images_per_cat, save_image_root, base_seed, image_format, shard_index, num_shards))
+        print(f"{model_id}: {num_missing} images missing in shard {shard_index} of {num_shards}")
+        if num_missing:
+            os.makedirs(os.path.join(save_image_root, os.path.basename(model_id.rstrip("/"))), exist_ok=True)
+            plan[model_id] = num_missing
+    return plan
+
+
+def manifest_path(save_image_root, shard_index, num_shards):
+    return os.path.join(save_image_root, f"manifest_shard{shard_index:03d}_of_{num_shards:03d}.jsonl")
+
+
+def write_manifest(model_ids, prompt_file, images_per_cat, save_image_root, base_seed=0, image_format="png",
+                   shard_index=0, num_shards=1):
+    """
+    Write the manifest of a shard: one JSONL record per existing image of the shard with its model, prompt and
+    image ids, seed, prompt and path relative to save_image_root. The manifest is replaced atomically.
+
+    :return: (manifest path, number of records)
+    """
+    path = manifest_path(save_image_root, shard_index, num_shards)
+    tmp_path = path + ".tmp"
+    num_records = 0
+    os.makedirs(save_image_root, exist_ok=True)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for model_id in model_ids:
+            images = iter_shard_images(model_id, prompt_file, images_per_cat, save_image_root, base_seed, image_format, shard_index, num_shards)
+            for prompt_id, image_id, prompt, seed, save_path in images:
+                if os.path.exists(save_path):
+                    record = dict(model_id=model_id, prompt_id=prompt_id, image_id=image_id, seed=seed, prompt=prompt,
+                                  path=os.path.relpath(save_path, save_image_root))
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    num_records += 1
+    os.replace(tmp_path, path)
+    return path, num_records
+
+
+def merge_manifests(save_image_root):
+    """
+    Merge the shard manifests found in save_image_root (after copying the shard outputs together) into
+    manifest.jsonl, dropping duplicates and reporting shards and images that are missing.
+    """
+    shard_files = sorted(name for name in os.listdir(save_image_root) if name.startswith("manifest_shard") and name.endswith(".jsonl"))
+    if not shard_files:
+        print(f"No shard manifests found in {save_image_root}")
+        return
+
+    num_shards = {int(name[:-len(".jsonl")].rsplit("_of_", 1)[1]) for name in shard_files}
+    if len(num_shards) > 1:
+        print(f"Warning: manifests of different shard counts {sorted(num_shards)} are merged")
+    found = {int(name[len("manifest_shard"):].split("_", 1)[0]) for name in shard_files}
+    missing_shards = sorted(set(range(max(num_shards))) - found)
+    if missing_shards:
+        print(f"Warning: manifests of shards {missing_shards} are missing")
+
+    seen = set()
+    num_missing_files = 0
+    path = os.path.join(save_image_root, "manifest.jsonl")
+    with open(path + ".tmp", "w", encoding="utf-8") as out:
+        for name in shard_files:
+            with open(os.path.join(save_image_root, name), "r", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record["path"] in seen:
+                        continue
+                    seen.add(record["path"])
+                    if not os.path.exists(os.path.join(save_image_root, record["path"])):
+                        num_missing_files += 1
+                    out.write(line)
+    os.replace(path + ".tmp", path)
+
+    print(f"Merged {len(seen)} images from {len(shard_files)} shard manifests into {path}")
+    if num_missing_files:
+        print(f"Warning: {num_missing_files} images listed in the manifests are missing in {save_image_root}")
+
+
+def default_dtype(device):
+    # half precision is only worthwhile on accelerators
+    return torch.float32 if device == "cpu" else torch.float16
+
+
+def read_pipeline(model_id, model_cls=None, torch_dtype=torch.float16):
+    """
+    load pipeline weights into CPU memory (safetensors weights are memory-mapped while loading)
+    """
     cache_dir = os.path.join(SAVED_MODEL_ROOT, model_id)
     os.makedirs(cache_dir, exist_ok=True)
     if model_cls:
-        pipe = model_cls.from_pretrained(model_id, torch_dtype=torch.float16, cache_dir=cache_dir)
+        pipe = model_cls.from_pretrained(model_id, torch_dtype=torch_dtype, cache_dir=cache_dir)
+    else:
+        pipe = AutoPipelineForText2Image.from_pretrained(model_id, torch_dtype=torch_dtype, cache_dir=cache_dir)
+    return pipe
+
+
+def resolve_memory_options(profile, options=None):
+    """
+    memory options of a model: command line values override the ones of the model profile
+    """
+    options = options or {}
+    return {name: options[name] if options.get(name) is not None else profile.get(name) for name in MEMORY_OPTIONS}
+
+
+def place_pipeline(pipe, device="cuda", scheduler=None, memory_options=None):
+    """
+    move a pipeline to its device and apply the memory options:
+        offload: None, "model" (whole models moved to the device when used) or "sequential" (submodules moved when used)
+        attention_slicing / vae_slicing / vae_tiling: compute attention and VAE decoding in slices or tiles
+        channels_last: channels-last memory format for the UNet and VAE
+        sdpa: torch scaled dot product attention processors for the UNet
+    """
+    memory_options = memory_options or {}
+    if scheduler:
+        pipe.scheduler = getattr(diffusers, scheduler).from_config(pipe.scheduler.config)
+
+    # offloading moves weights between CPU and an accelerator, there is nothing to offload to on CPU
+    offload = memory_options.get("offload") if device != "cpu" else None
+    if offload == "model":
+        pipe.enable_model_cpu_offload(device=device)
+    elif offload == "sequential":
+        pipe.enable_sequential_cpu_offload(device=device)
     else:
-        pipe = AutoPipelineForText2Image.from_pretrained(model_id, torch_dtype=torch.float16, cache_dir=cache_dir)
-    pipe = pipe.to(device)
+        pipe = pipe.to(device)
+
+    if memory_options.get("channels_last"):
+        for module_name in ("unet", "vae"):
+            if getattr(pipe, module_name, None) is not None:
+                getattr(pipe, module_name).to(memory_format=torch.channels_last)
+    if memory_options.get("sdpa") and getattr(pipe, "unet", None) is not None:
+        from diffusers.models.attention_processor import AttnProcessor2_0
+        pipe.unet.set_attn_processor(AttnProcessor2_0())
+    # slicing replaces the attention processors, so it is applied after sdpa
+    if memory_options.get("attention_slicing"):
+        pipe.enable_attention_slicing()
+    if memory_options.get("vae_slicing"):
+        pipe.vae.enable_slicing()
+    if memory_options.get("vae_tiling"):
+        pipe.vae.enable_tiling()
+
     pipe.set_progress_bar_config(disable=True)
     return pipe
 
 
+def load_pipeline(model_id, model_cls=None, device="cuda", torch_dtype=None, scheduler=None, memory_options=None):
+    pipe = read_pipeline(model_id, model_cls, torch_dtype or default_dtype(device))
+    return place_pipeline(pipe, device, scheduler, memory_options)
+
+
+def estimate_pipeline_bytes(model_id):
+    """
+    size of the weight files of a downloaded or local pipeline, 0 if nothing is on disk yet
+    """
+    root = model_id if os.path.isdir(model_id) else os.path.join(SAVED_MODEL_ROOT, model_id)
+    sizes = {".safetensors": 0, ".bin": 0}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            extension = os.path.splitext(filename)[1]
+            if extension in sizes:
+                # hub cache blobs have no extension, so each weight file is counted once through its snapshot link
+                sizes[extension] += os.path.getsize(os.path.join(dirpath, filename))
+    return sizes[".safetensors"] or sizes[".bin"]
+
+
+
+# pipeline class: (extra encode_prompt arguments, pipeline call argument of every encode_prompt output, whether
+# encode_prompt takes classifier-free guidance arguments); None skips outputs the pipeline recomputes itself
+PROMPT_ENCODERS = {
+    "StableDiffusionPipeline": (
+        {}, ("prompt_embeds", "negative_prompt_embeds"), True),
+    "StableDiffusionXLPipeline": (
+        {"prompt_2": None},
+        ("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds", "negative_pooled_prompt_embeds"), True),
+    "StableDiffusion3Pipeline": (
+        {"prompt_2": None, "prompt_3": None},
+        ("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds", "negative_pooled_prompt_embeds"), True),
+    "FluxPipeline": (
+        {"prompt_2": None}, ("prompt_embeds", "pooled_prompt_embeds", None), False),
+}
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of the text encoder outputs of one pipeline, so that the prompt and NEGATIVE_PROMPTS are encoded
+    once per prompt instead of once per image. Pipelines missing from PROMPT_ENCODERS are not supported.
+    """
+
+    def __init__(self, pipe, profile, device, max_size=64):
+        self.pipe = pipe
+        self.device = device
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.encoder = PROMPT_ENCODERS.get(type(pipe).__name__)
+
+        guidance_scale = profile.get("guidance_scale")
+        self.do_classifier_free_guidance = guidance_scale is None or guidance_scale > 1
+        self.negative_prompt = NEGATIVE_PROMPTS if profile.get("negative_prompt_arg") else None
+
+    @property
+    def supported(self):
+        return self.encoder is not None and self.max_size > 0
+
+    def get(self, prompt):
+        """
+        return the pipeline call arguments (prompt_embeds, ...) of a prompt, encoding it on a cache miss
+        """
+        if prompt in self.entries:
+            self.entries.move_to_end(prompt)
+            return self.entries[prompt]
 
-def generate_image(pipe, prompt):
+        extra_kwargs, output_names, takes_guidance = self.encoder
+        encode_kwargs = dict(prompt=prompt, device=self.device, num_images_per_prompt=1, **extra_kwargs)
+        if takes_guidance:
+            encode_kwargs.update(do_classifier_free_guidance=self.do_classifier_free_guidance, negative_prompt=self.negative_prompt)
+
+        with torch.no_grad():
+            outputs = self.pipe.encode_prompt(**encode_kwargs)
+        embeddings = {name: output for name, output in zip(output_names, outputs) if name and output is not None}
+
+        self.entries[prompt] = embeddings
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return embeddings
+
+    def batch_kwargs(self, prompts):
+        """
+        pipeline call arguments of a batch, one repeated prompt uses num_images_per_prompt
+        """
+        if len(set(prompts)) == 1:
+            return dict(**self.get(prompts[0]), num_images_per_prompt=len(prompts))
+
+        embeddings = [self.get(prompt) for prompt in prompts]
+        return dict({name: torch.cat([e[name] for e in embeddings]) for name in embeddings[0]}, num_images_per_prompt=1)
+
+
+def generate_images(pipe, prompts, seeds=None, profile=None, num_inference_steps=None, prompt_cache=None):
+    """
+    Generate one image per entry of prompts with a single pipeline call. A batch of one repeated prompt uses
+    num_images_per_prompt, mixed prompts are passed as a list. seeds gives one seed per image (or None).
+    Steps, guidance scale, resolution and the negative prompt argument come from the model profile.
+    With a supported prompt_cache, cached prompt embeddings are passed instead of the prompts.
+    """
+    profile = profile or {}
+    if prompt_cache is not None and prompt_cache.supported:
+        prompt_kwargs = prompt_cache.batch_kwargs(prompts)
+    elif len(set(prompts)) == 1:
+        prompt_kwargs = dict(prompt=prompts[0], num_images_per_prompt=len(prompts))
+    else:
+        prompt_kwargs = dict(prompt=list(prompts), num_images_per_prompt=1)
+
+    # one generator per image keeps every image reproducible independently of the batch it lands in
+    generator = None
+    if seeds is not None and all(seed is not None for seed in seeds):
+        generator = [torch.Generator(device="cpu").manual_seed(seed) for seed in seeds]
+
+    call_kwargs = dict(num_inference_steps=num_inference_steps or profile.get("num_inference_steps", 50))
+    for name in ("guidance_scale", "height", "width"):
+        if profile.get(name) is not None:
+            call_kwargs[name] = profile[name]
+    negative_prompt_arg = profile.get("negative_prompt_arg", "negative_prompt")
+    if negative_prompt_arg and "prompt_embeds" not in prompt_kwargs:
+        call_kwargs[negative_prompt_arg] = NEGATIVE_PROMPTS
+
+    return pipe(**prompt_kwargs, **call_kwargs, generator=generator).images
+
+
+def probe_batch_size(pipe, device, profile=None, max_batch_size=8, headroom=0.9):
+    """
+    Estimate the largest batch that fits in device memory from the peak memory of one-step runs with
+    batch sizes 1 and 2. CPU devices use a batch size of 1.
+    """
+    if not device.startswith("cuda") or max_batch_size <= 1:
+        return 1
+
+    peaks = []
     try:
-        image = pipe(
-            prompt=prompt,
-            num_inference_steps=50,
-            negative_prompts=NEGATIVE_PROMPTS,
-        ).images[0]
-    except:
-        image = pipe(
-            prompt=prompt,
-            num_inference_steps=50,
-            negative_prompt=NEGATIVE_PROMPTS,
-        ).images[0]
+        for batch_size in (1, 2):
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline = torch.cuda.memory_allocated(device)
+            generate_images(pipe, ["memory probe"] * batch_size, profile=profile, num_inference_steps=1)
+            peaks.append(torch.cuda.max_memory_allocated(device) - baseline)
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        return 1
 
-    return image
+    per_image = max(peaks[1] - peaks[0], 1)
+    fixed = max(peaks[0] - per_image, 0)
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    available = free_memory + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
 
+    batch_size = int((available * headroom - fixed) // per_image)
+    return max(1, min(batch_size, max_batch_size))
 
 
-def generate_image_and_save(pipe, prompt, save_path):
-    if not os.path.exists(save_path):
-        image = generate_image(pipe, prompt)
-        image.save(save_path)
+def save_image_atomic(image, save_path, image_format="png", compress_level=6):
+    """
+    encode and write an image to a temporary file next to save_path, then rename it into place
+    """
+    tmp_path = save_path + ".tmp"
+    try:
+        if image_format == "webp":
+            image.save(tmp_path, format="WEBP", lossless=True)
+        else:
+            image.save(tmp_path, format="PNG", compress_level=compress_level)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        # a partial temporary file would otherwise stay next to the images
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def current_rss_bytes():
+    """
+    resident set size of this process, from psutil if installed, else from /proc on Linux (None if unavailable)
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
 
 
+class RssSampler:
+    """
+    Background thread sampling the resident set size of the process. ru_maxrss is the peak over the whole life of
+    a worker, so the sampler is reset at every model switch to measure the peak of each model on its own.
+    """
 
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        rss = current_rss_bytes()
+        if rss is not None:
+            with self.lock:
+                self.peak = max(self.peak, rss)
+
+    def reset(self):
+        with self.lock:
+            self.peak = 0
+        self.sample()
+
+    def peak_mb(self):
+        """
+        peak RSS in MB since the last reset, None if the RSS cannot be read on this platform
+        """
+        self.sample()
+        return self.peak / 1024 ** 2 if self.peak else None
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class ImageSaver:
+    """
+    Write-behind saver: images are queued in a bounded queue that a pool of threads drains, encoding and writing
+    them with save_image_atomic. submit() blocks while max_pending images are waiting, so a slow disk slows
+    generation down instead of filling memory. callback(save_path, error) is called once the image is written.
+    """
+
+    def __init__(self, num_threads=2, max_pending=16, image_format="png", compress_level=6):
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.threads = [threading.Thread(target=self._drain, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            image, save_path, callback = item
+            try:
+                save_image_atomic(image, save_path, self.image_format, self.compress_level)
+                callback(save_path, None)
+            except Exception as e:
+                callback(save_path, f"{type(e).__name__}: {e}")
+
+    def submit(self, image, save_path, callback):
+        self.queue.put((image, save_path, callback))
+
+    def close(self):
+        """
+        wait until all queued images are written
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def release_pipeline(pipe, device):
+    del pipe
+    gc.collect()
+    if device.startswith("cuda"):
+        torch.cuda.empty_cache()
+
+
+def resolve_batch_size(pipe, profile, device, batch_size=None, max_batch_size=8):
+    """
+    batch size given on the command line, else the one of the model profile, else a memory probe
+    """
+    if batch_size:
+        return batch_size
+    if profile.get("batch_size"):
+        return profile["batch_size"]
+    return probe_batch_size(pipe, device, profile, max_batch_size)
+
+
+def pipeline_class(profile):
+    return getattr(diffusers, profile["pipeline_class"]) if profile.get("pipeline_class") else None
+
+
+def generation_worker(device, job_queue, result_queue, profiles, model_schedule, options):
+    """
+    Worker process owning one device. Pipelines are loaded once per model inside the worker and jobs
+    (model_id, prompt, seed, save_path) are pulled from the shared queue until a None sentinel arrives.
+    Queued jobs of the same model are generated together in batches, while the weights of the next model
+    in model_schedule are prefetched into CPU memory on a background thread.
+    Every job is answered on result_queue with (save_path, error), error being None on success.
+    """
+    pipe, current_model_id, load_error = None, None, None
+    prompt_cache, model_batch_size = None, 1
+    pending = []
+    prefetcher = ThreadPoolExecutor(max_workers=1)
+    saver = ImageSaver(options["save_threads"], options["max_pending_saves"], options["image_format"], options["compress_level"])
+
+    def report(save_path, error):
+        result_queue.put((save_path, error))
+    prefetched = {}
+    timings = None
+    rss_sampler = RssSampler()
+
+    def prefetch_next(model_id):
+        index = model_schedule.index(model_id) if model_id in model_schedule else len(model_schedule)
+        if index + 1 >= len(model_schedule):
+            return
+        next_model_id = model_schedule[index + 1]
+        size = estimate_pipeline_bytes(next_model_id)
+        if size == 0 or size > options["prefetch_memory_gb"] * 1024 ** 3:
+            return
+        next_profile = get_profile(profiles, next_model_id)
+        prefetched[next_model_id] = prefetcher.submit(read_pipeline, next_model_id, pipeline_class(next_profile), default_dtype(device))
+
+    def log_timings():
+        if not timings:
+            return
+        timings["images_per_second"] = timings["images"] / timings["generate"] if timings["generate"] else 0.0
+        # includes the weights of the next model while they are prefetched, which are held at the same time
+        timings["peak_rss_mb"] = rss_sampler.peak_mb()
+        if device.startswith("cuda"):
+            timings["peak_device_mb"] = torch.cuda.max_memory_allocated(device) / 1024 ** 2
+        print(f"[{device}] {timings['model_id']}: load {timings['load']:.1f}s, "
+              f"generate {timings['generate']:.1f}s for {timings['images']} images ({timings['images_per_second']:.2f} images/s), "
+              f"unload {timings['unload']:.1f}s, peak RSS {timings['peak_rss_mb'] or 0:.0f} MB, "
+              f"peak device memory {timings.get('peak_device_mb', 0):.0f} MB")
+        if options.get("report_file"):
+            with open(options["report_file"], "a") as f:
+                f.write(json.dumps(dict(timings, device=device)) + "\n")
+
+    while True:
+        job = pending.pop() if pending else job_queue.get()
+        if job is None:
+            break
+        model_id = job[0]
+
+        # jobs are queued model by model, so each worker switches pipelines at most once per model
+        if model_id != current_model_id:
+            prompt_cache = None
+            if pipe is not None:
+                start = time.perf_counter()
+                release_pipeline(pipe, device)
+                pipe = None
+                timings["unload"] = time.perf_counter() - start
+            log_timings()
+            rss_sampler.reset()
+
+            current_model_id, load_error = model_id, None
+            profile = get_profile(profiles, model_id)
+            memory_options = resolve_memory_options(profile, options)
+            timings = dict(model_id=model_id, memory_options=memory_options, load=0.0, generate=0.0, images=0, unload=0.0)
+            if device.startswith("cuda"):
+                torch.cuda.reset_peak_memory_stats(device)
+            start = time.perf_counter()
+            try:
+                prefetch = prefetched.pop(model_id, None)
+                # a prefetch of a model this worker never received jobs for is dropped
+                prefetched.clear()
+                prefetched_pipe = None
+                if prefetch is not None:
+                    try:
+                        prefetched_pipe = prefetch.result()
+                    except Exception as e:
+                        # the prefetch may fail for transient reasons (e.g. memory pressure), so the model is loaded again
+                        print(f"[{device}] prefetch of {model_id} failed ({type(e).__name__}: {e}), loading it directly")
+                if prefetched_pipe is not None:
+                    pipe = place_pipeline(prefetched_pipe, device, profile.get("scheduler"), memory_options)
+                else:
+                    pipe = load_pipeline(model_id, pipeline_class(profile), device=device, scheduler=profile.get("scheduler"), memory_options=memory_options)
+                model_batch_size = resolve_batch_size(pipe, profile, device, options["batch_size"], options["max_batch_size"])
+                prompt_cache = PromptEmbeddingCache(pipe, profile, device, options["prompt_cache_size"])
+            except Exception as e:
+                load_error = f"failed to load {model_id} on {device}: {type(e).__name__}: {e}"
+            timings["load"] = time.perf_counter() - start
+            prefetch_next(model_id)
+
+        # fill the batch with already queued jobs of the same model, anything else is kept for the next round
+        batch = [job]
+        while len(batch) < model_batch_size:
+            try:
+                next_job = job_queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            if next_job is None or next_job[0] != model_id:
+                pending.append(next_job)
+                break
+            batch.append(next_job)
+
+        if load_error:
+            for _, _, _, save_path in batch:
+                result_queue.put((save_path, load_error))
+            continue
+
+        todo = [item for item in batch if not os.path.exists(item[3])]
+        for _, _, _, save_path in batch:
+            if os.path.exists(save_path):
+                result_queue.put((save_path, None))
+        if not todo:
+            continue
+
+        start = time.perf_counter()
+        try:
+            images = generate_images(pipe, [item[1] for item in todo], [item[2] for item in todo], profile, prompt_cache=prompt_cache)
+            # results are reported by the saver once each image is on disk
+            for (_, _, _, save_path), image in zip(todo, images):
+                saver.submit(image, save_path, report)
+            timings["images"] += len(todo)
+        except Exception as e:
+            for _, _, _, save_path in todo:
+                result_queue.put((save_path, f"{type(e).__name__}: {e}"))
+        timings["generate"] += time.perf_counter() - start
+
+    prompt_cache = None
+    if pipe is not None:
+        start = time.perf_counter()
+        release_pipeline(pipe, device)
+        timings["unload"] = time.perf_counter() - start
+    log_timings()
+    rss_sampler.close()
+    saver.close()
+    prefetcher.shutdown(cancel_futures=True)
+
+
+def run_generation_workers(jobs, num_jobs, model_schedule, devices, profiles, options):
+    """
+    Start one persistent worker process per device, feed it the jobs and yield results as they finish. Jobs are
+    consumed lazily by a feeder thread through a bounded queue, so large job spaces are never held in memory.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    job_queue = ctx.Queue(maxsize=max(64, 4 * options["max_batch_size"]) * len(devices))
+    result_queue = ctx.Queue()
+
+    workers = [
+        ctx.Process(target=generation_worker, args=(device, job_queue, result_queue, profiles, model_schedule, options), daemon=True)
+        for device in devices
+    ]
+    for worker in workers:
+        worker.start()
+
+    def feed_jobs():
+        for job in jobs:
+            job_queue.put(job)
+        for _ in workers:
+            job_queue.put(None)
+
+    threading.Thread(target=feed_jobs, name="job-feeder", daemon=True).start()
+
+    remaining = num_jobs
+    while remaining > 0:
+        try:
+            yield result_queue.get(timeout=10)
+            remaining -= 1
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                print(f"All generation workers exited with {remaining} jobs unfinished")
+                break
+
+    for worker in workers:
+        worker.join()
+
+
+BENCHMARK_FIELDS = [
+    "model_id", "num_inference_steps", "batch_size", "dtype", "memory_options", "load_seconds",
+    "warmup_images_per_second", "steady_images_per_second", "peak_rss_mb", "peak_device_mb", "bytes_written", "error",
+]
+
+
+def parse_benchmark_args(argv):
+    parser = argparse.ArgumentParser(prog='image_generate.py benchmark', description='Benchmark image generation over a grid of models, steps, batch sizes, dtypes and memory options')
+    parser.add_argument('--model_ids', type=str, nargs='+', default=['hf-internal-testing/tiny-stable-diffusion-pipe'], help='model ids (already downloaded to the model cache) or local pipeline folders, tiny test pipelines keep the grid fast')
+    parser.add_argument('--steps', type=int, nargs='+', default=[2, 4], help='numbers of inference steps')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4], help='images per pipeline call')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['float32'], choices=['float32', 'bfloat16', 'float16'], help='torch dtypes of the pipeline weights')
+    parser.add_argument('--memory_options', type=str, nargs='+', default=['none'], help="memory option sets, each one 'none' or options joined by '+', e.g. attention_slicing+vae_tiling or offload=model")
+    parser.add_argument('--device', type=str, default='cpu', help='device to benchmark on')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch intra-op threads (default: torch default)')
+    parser.add_argument('--warmup_batches', type=int, default=1, help='batches generated before steady-state timing starts')
+    parser.add_argument('--num_batches', type=int, default=4, help='batches timed for the steady-state images/s')
+    parser.add_argument('--image_format', type=str, default='png', choices=['png', 'webp'], help='format of the written images')
+    parser.add_argument('--profile_file', type=str, default=PROFILE_FILE, help='JSON or YAML file with per-model generation profiles')
+    parser.add_argument('--allow_download', action='store_true', help='allow downloading missing pipelines, the benchmark runs offline by default')
+    parser.add_argument('--output', type=str, default=None, help='path to the result table (.csv or .json), printed to stdout as CSV if not given')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON result table of a previous run, the benchmark fails if a configuration got slower')
+    parser.add_argument('--max_regression', type=float, default=0.2, help='largest accepted relative drop of steady-state images/s against --baseline')
+    return parser.parse_args(argv)
+
+
+def parse_memory_option_set(spec):
+    """
+    'none', 'attention_slicing+vae_tiling' or 'offload=model' -> memory options dict
+    """
+    memory_options = {name: None for name in MEMORY_OPTIONS}
+    if spec == "none":
+        return memory_options
+    for option in spec.split("+"):
+        name, _, value = option.partition("=")
+        if name not in MEMORY_OPTIONS:
+            raise ValueError(f"Unknown memory option {name}, expected one of {MEMORY_OPTIONS}")
+        memory_options[name] = value or True
+    return memory_options
+
+
+def benchmark_worker(config, options, result_queue):
+    """
+    Benchmark one configuration in a fresh process, so that peak memory is measured per configuration.
+    Puts a result row on result_queue.
+    """
+    device = options["device"]
+    row = dict(config, error=None)
+    try:
+        if options["num_threads"]:
+            torch.set_num_threads(options["num_threads"])
+        if device.startswith("cuda"):
+            torch.cuda.reset_peak_memory_stats(device)
+
+        profile = get_profile(load_generation_profiles(options["profile_file"]), config["model_id"])
+        profile = dict(profile, num_inference_steps=config["num_inference_steps"])
+        memory_options = parse_memory_option_set(config["memory_options"])
+
+        start = time.perf_counter()
+        pipe = load_pipeline(config["model_id"], pipeline_class(profile), device=device, torch_dtype=getattr(torch, config["dtype"]),
+                             scheduler=profile.get("scheduler"), memory_options=memory_options)
+        row["load_seconds"] = time.perf_counter() - start
+
+        batch_size = config["batch_size"]
+        batches = [
+            [prompts[(batch_id * batch_size + i) % len(prompts)] for i in range(batch_size)]
+            for batch_id in range(options["warmup_batches"] + options["num_batches"])
+        ]
+        warmup, steady = batches[:options["warmup_batches"]], batches[options["warmup_batches"]:]
+
+        start = time.perf_counter()
+        for batch in warmup:
+            generate_images(pipe, batch, list(range(batch_size)), profile)
+        warmup_seconds = time.perf_counter() - start
+        row["warmup_images_per_second"] = len(warmup) * batch_size / warmup_seconds if warmup else 0.0
+
+        errors = []
+
+        def report(save_path, error):
+            if error:
+                errors.append(error)
+
+        with tempfile.TemporaryDirectory() as save_root:
+            saver = ImageSaver(image_format=options["image_format"])
+            start = time.perf_counter()
+            for batch_id, batch in enumerate(steady):
+                images = generate_images(pipe, batch, list(range(batch_size)), profile)
+                for image_id, image in enumerate(images):
+                    save_path = os.path.join(save_root, f"{batch_id}_{image_id}.{options['image_format']}")
+                    saver.submit(image, save_path, report)
+            # steady-state throughput includes writing the last images
+            saver.close()
+            steady_seconds = time.perf_counter() - start
+            row["bytes_written"] = sum(entry.stat().st_size for entry in os.scandir(save_root))
+
+        row["steady_images_per_second"] = len(steady) * batch_size / steady_seconds if steady else 0.0
+        row["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        row["peak_device_mb"] = torch.cuda.max_memory_allocated(device) / 1024 ** 2 if device.startswith("cuda") else 0.0
+        if errors:
+            row["error"] = errors[0]
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    result_queue.put(row)
+
+
+def benchmark_key(row):
+    return row["model_id"], row["num_inference_steps"], row["batch_size"], row["dtype"], row["memory_options"]
+
+
+def run_benchmark(argv):
+    """
+    Run every configuration of the grid in its own spawned process and write the result table.
+    Returns the exit code: 1 if a configuration failed or regressed against the baseline.
+    """
+    args = parse_benchmark_args(argv)
+    if not args.allow_download:
+        os.environ["HF_HUB_OFFLINE"] = "1"
+    for spec in args.memory_options:
+        # place_pipeline skips offloading on CPU, so the row would report numbers of a configuration that never ran
+        if parse_memory_option_set(spec)["offload"] not in (None, "none") and args.device == "cpu":
+            raise SystemExit(f"Memory option set {spec} offloads to an accelerator, it cannot be benchmarked on --device cpu")
+
+    options = dict(
+        device=args.device, num_threads=args.num_threads, warmup_batches=args.warmup_batches, num_batches=args.num_batches,
+        image_format=args.image_format, profile_file=args.profile_file,
+    )
+    ctx = multiprocessing.get_context("spawn")
+    rows = []
+    for model_id, steps, batch_size, dtype, memory_options in itertools.product(args.model_ids, args.steps, args.batch_sizes, args.dtypes, args.memory_options):
+        config = dict(model_id=model_id, num_inference_steps=steps, batch_size=batch_size, dtype=dtype, memory_options=memory_options)
+        result_queue = ctx.Queue()
+        process = ctx.Process(target=benchmark_worker, args=(config, options, result_queue))
+        process.start()
+        row = None
+        try:
+            # a child killed before reporting (OOM kill, crash in the pipeline) must not hang the benchmark
+            while row is None:
+                try:
+                    row = result_queue.get(timeout=5)
+                except queue.Empty:
+                    if process.is_alive():
+                        continue
+                    try:
+                        # the row may have been sent right before the child exited
+                        row = result_queue.get(timeout=1)
+                    except queue.Empty:
+                        row = dict(config, error=f"benchmark process exited with code {process.exitcode} without a result")
+        except KeyboardInterrupt:
+            process.terminate()
+            raise
+        process.join()
+
+        row = {field: row.get(field) for field in BENCHMARK_FIELDS}
+        rows.append(row)
+        if row["error"]:
+            print(f"{config}: {row['error']}")
+        else:
+            print(f"{model_id} steps={steps} batch={batch_size} {dtype} {memory_options}: load {row['load_seconds']:.1f}s, "
+                  f"warm-up {row['warmup_images_per_second']:.2f} images/s, steady {row['steady_images_per_second']:.2f} images/s, "
+                  f"peak RSS {row['peak_rss_mb']:.0f} MB, {row['bytes_written'] / 1024:.0f} KB written")
+
+    if args.output and args.output.endswith(".json"):
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=4)
+    else:
+        f = open(args.output, "w", newline="") if args.output else sys.stdout
+        writer = csv.DictWriter(f, fieldnames=BENCHMARK_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+        if args.output:
+            f.close()
+
+    exit_code = 1 if any(row["error"] for row in rows) else 0
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = {benchmark_key(row): row for row in json.load(f)}
+        for row in rows:
+            reference = baseline.get(benchmark_key(row))
+            if row["error"] or not reference or not reference.get("steady_images_per_second"):
+                continue
+            change = row["steady_images_per_second"] / reference["steady_images_per_second"] - 1
+            if change < -args.max_regression:
+                print(f"Regression {benchmark_key(row)}: {reference['steady_images_per_second']:.2f} -> {row['steady_images_per_second']:.2f} images/s ({change:+.1%})")
+                exit_code = 1
+    return exit_code
 
 
 if __name__ == '__main__':
-    multiprocessing.set_start_method('spawn')
+    if sys.argv[1:2] == ["benchmark"]:
+        raise SystemExit(run_benchmark(sys.argv[2:]))
 
     args = parse_args()
 
-    devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
-
-    for model_id in tqdm(model_ids, desc="Models"):
-        # load pipeline
-        pipes = [load_pipeline(model_id, device=d) for d in devices]
-        save_root = os.path.join(args.save_image_root, os.path.basename(model_id))
-
-        prompt_list = []
-        save_path_list = []
-        pipe_list = []
-
-        os.makedirs(save_root, exist_ok=True)
-        # generate images
-        i = 0
-        for prompt_id, prompt in (enumerate(prompts)):
-            for image_id in range(args.images_per_cat):
-                save_path = os.path.join(save_root, f"{prompt_id}_{image_id}.png")
-                prompt_list.append(prompt)
-                save_path_list.append(save_path)
-                pipe_list.append(pipes[i % len(pipes)])
-                i += 1
-
-
-        with ProcessPoolExecutor(max_workers=args.max_workers) as executor:
-            list(tqdm(executor.map(generate_image_and_save, pipe_list, prompt_list, save_path_list),
-                      total=len(prompts)*args.images_per_cat, desc="Images"))
-        
-        # clean pipeline cache
-        del pipes
-        del prompt_list
-        del save_path_list
-        del pipe_list
-        gc.collect()
-
-        prompt_list = []
-        save_path_list = []
-        pipe_list = []
+    devices = args.devices or [f"cuda:{i}" for i in range(torch.cuda.device_count())] or ["cpu"]
+    devices = devices[:args.max_workers]
+
+    if args.merge_manifests:
+        merge_manifests(args.save_image_root)
+        raise SystemExit(0)
+    if not 0 <= args.shard_index < args.num_shards:
+        raise SystemExit(f"--shard_index must be in [0, {args.num_shards})")
+
+    selected_model_ids = args.model_ids or model_ids
+    shard = dict(shard_index=args.shard_index, num_shards=args.num_shards)
+    plan = plan_jobs(selected_model_ids, args.prompt_file, args.images_per_cat, args.save_image_root, args.seed, args.image_format, **shard)
+    num_jobs = sum(plan.values())
+    if not num_jobs:
+        print("All images already exist, nothing to generate")
+    jobs = itertools.chain.from_iterable(
+        iter_model_jobs(model_id, args.prompt_file, args.images_per_cat, args.save_image_root, args.seed, args.image_format, **shard)
+        for model_id in plan
+    )
+
+    failed = 0
+    profiles = load_generation_profiles(args.profile_file)
+    options = dict(
+        batch_size=args.batch_size,
+        max_batch_size=args.max_batch_size,
+        prompt_cache_size=args.prompt_cache_size,
+        prefetch_memory_gb=args.prefetch_memory_gb,
+        save_threads=args.save_threads,
+        max_pending_saves=args.max_pending_saves,
+        image_format=args.image_format,
+        compress_level=args.compress_level,
+        report_file=args.report_file,
+        **{name: getattr(args, name) for name in MEMORY_OPTIONS},
+    )
+    results = run_generation_workers(jobs, num_jobs, list(plan), devices, profiles, options)
+    for save_path, error in tqdm(results, total=num_jobs, desc="Images"):
+        if error:
+            failed += 1
+            print(f"Failed to generate {save_path}: {error}")
+
+    print(f"{num_jobs - failed} of {num_jobs} images generated on {len(devices)} device(s)")
+
+    path, num_records = write_manifest(selected_model_ids, args.prompt_file, args.images_per_cat, args.save_image_root, args.seed, args.image_format, **shard)
+    print(f"Manifest of {num_records} images saved to {path}")
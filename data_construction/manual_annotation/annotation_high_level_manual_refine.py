@@ -1,12 +1,15 @@
-import json
 import re
 import argparse
 import os
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 from tqdm import tqdm
 
 from utils.gpt4o import gpt4o_response
+from utils.utils import iter_annotations
 
 
 
@@ -66,7 +69,8 @@ Based on the hints, rewrite the original annotation text to better describe the
 
 
 def replace_image_path(url, image_root):
-    # match any protocol/domain/IP, extract the path after images/
+    # drop preview arguments (?w=...&fmt=...), then match any protocol/domain/IP, extract the path after images/
+    url = url.split("?", 1)[0]
     pattern = r".*/images/(.*)"
     match = re.match(pattern, url)
     if match:
@@ -75,13 +79,12 @@ def replace_image_path(url, image_root):
     return url  # return original path if not matched
 
 def extract_data(json_file, image_root):
-    with open(json_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    results = []
-    for task in data:
-        # replace image path
-        original_image_url = task['data']['image']
+    """
+    stream the tasks of a Label Studio export (JSON array or JSONL) without loading the whole file
+    """
+    for task in iter_annotations(json_file):
+        # replace image path, tasks with preview images keep the full-resolution url in original_image
+        original_image_url = task['data'].get('original_image', task['data']['image'])
         local_image_path = replace_image_path(original_image_url, image_root)
         
         # extract text and choices
@@ -96,13 +99,79 @@ def extract_data(json_file, image_root):
                     choices = result_item['value'].get('choices', [])
                     choices_list.extend(choices)
         
-        results.append({
+        yield {
             "revisions": suggestion_list,
             "choices": choices_list,
             "image_path": local_image_path
-        })
-    
-    return results
+        }
+
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    hardlink src to dst, fall back to a reflink (copy-on-write clone) and finally to a plain copy
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+        FICLONE = 0x40049409 # Linux ioctl cloning file extents on btrfs/XFS
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copy2(src, dst)
+
+
+def link_atomic(src, dst):
+    # the temporary name is unique per thread, so concurrent tasks staging the same image never collide
+    tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        link_or_copy(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        # rename does nothing when dst is already a hardlink of the same file, which leaves tmp_path behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def stage_image(image_path, staging_root):
+    """
+    Content-addressed staging: the image is stored once as staging_root/.objects/<sha256[:2]>/<sha256><ext>
+    and staging_root/<subfolder>/<image name> is a hardlink of that object. Identical images of different tasks
+    share one object, and an image that is already staged (same inode as the original) is not even hashed.
+    """
+    image_name = os.path.basename(image_path)
+    subfolder = os.path.basename(os.path.dirname(image_path))
+    image_subfolder = os.path.join(staging_root, subfolder)
+    new_image_path = os.path.join(image_subfolder, image_name)
+    os.makedirs(image_subfolder, exist_ok=True)
+
+    if os.path.exists(new_image_path) and os.path.samefile(image_path, new_image_path):
+        return new_image_path
+
+    digest = file_hash(image_path)
+    object_folder = os.path.join(staging_root, ".objects", digest[:2])
+    object_path = os.path.join(object_folder, digest + os.path.splitext(image_name)[1].lower())
+    os.makedirs(object_folder, exist_ok=True)
+    if not os.path.exists(object_path):
+        link_atomic(image_path, object_path)
+
+    if not (os.path.exists(new_image_path) and os.path.samefile(object_path, new_image_path)):
+        link_atomic(object_path, new_image_path)
+    return new_image_path
 
 
 
@@ -119,28 +188,25 @@ def get_annotation_path(image_path, output_folder):
 
     return output_path
 
-def revise_annotation(metadata, output_folder):
+def revise_annotation(metadata, output_folder, staging_root, verbose=False):
 
     image_path = metadata["image_path"]
+
+    # finished tasks are skipped before touching any file
+    output_path = get_annotation_path(image_path, output_folder)
+    if os.path.exists(output_path):
+        return
+
     original_text = '\n'.join([f"<begin_of_point>\n{choice}<end_of_point>" for choice in metadata["choices"]])
     manual_revisions = '\n'.join([f"{i + 1}. {revision}" for i, revision in enumerate(metadata["revisions"])])
 
-    # save to new image path
-    import shutil
-    image_name = os.path.basename(image_path)
-    subfolder = os.path.basename(os.path.dirname(image_path))
-    image_subfolder = os.path.join("mygenImages_benchmark_selected_20250403", subfolder) 
-    new_image_path = os.path.join(image_subfolder, image_name)
-    os.makedirs(image_subfolder, exist_ok=True)
-    shutil.copy(image_path, new_image_path)
+    # stage the reviewed image next to the other selected images
+    stage_image(image_path, staging_root)
 
     prompt = manual_revise_prompt.format(original_text=original_text, manual_revisions=manual_revisions)
-    print(prompt)
-    print("="*70)
-
-    output_path = get_annotation_path(image_path, output_folder)
-    if os.path.exists(output_path):
-        return
+    if verbose:
+        print(prompt)
+        print("="*70)
 
     refined_text = gpt4o_response(prompt, image_path)
 
@@ -156,13 +222,28 @@ if __name__ == '__main__':
     parser.add_argument("--image_root", default="generated_images", help="Path to the folder containing images.")
     parser.add_argument("--annotation_root", default="generated_annotation_high_level_revised_manual", help="Path to the folder where high-level output text files will be saved.")
     parser.add_argument("--max_workers", type=int, default=4, help="Maximum number of worker threads. (Default: number of CPU cores)")
+    parser.add_argument("--staging_root", default="mygenImages_benchmark_selected_20250403", help="Folder receiving the reviewed images, hardlinked (or reflinked/copied) from image_root.")
+    parser.add_argument("--verbose", action="store_true", help="Print the full revision prompt of every task.")
     args = parser.parse_args()
 
     os.makedirs(args.annotation_root, exist_ok=True)
 
+    # counting streams the export once more, which is cheap next to the API calls
+    num_tasks = sum(1 for _ in iter_annotations(args.json_path))
     data = extract_data(args.json_path, args.image_root)
 
-    # Use a thread pool to process images in parallel
-    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
-        list(tqdm(executor.map(revise_annotation, data, [args.annotation_root] * len(data)),
-                  total=len(data), desc="Processing images"))
\ No newline at end of file
+    # Use a thread pool to process images in parallel, with a bounded number of submitted tasks so that the
+    # streamed export is never held in memory as futures
+    max_in_flight = args.max_workers * 4
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor, tqdm(total=num_tasks, desc="Processing images") as progress:
+        pending = set()
+        for metadata in data:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    progress.update()
+            pending.add(executor.submit(revise_annotation, metadata, args.annotation_root, args.staging_root, args.verbose))
+        for future in as_completed(pending):
+            future.result()
+            progress.update()
@@ -1,30 +1,115 @@
 import os
 import json
-import re
+import hashlib
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.constants import *
+from utils.utils import parse_text
 
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+
+def scan_images(image_dir, text_dir):
+    """
+    walk image_dir with os.scandir and yield (subfolder, image DirEntry, text path) of every image whose
+    subfolder also exists in text_dir, in sorted order
+    """
+    with os.scandir(image_dir) as entries:
+        subfolders = sorted(entry.name for entry in entries if entry.is_dir())
+    for subfolder in subfolders:
+        text_subdir = os.path.join(text_dir, subfolder)
+        if not os.path.isdir(text_subdir):
+            continue
+        with os.scandir(os.path.join(image_dir, subfolder)) as entries:
+            images = sorted((entry for entry in entries if entry.name.lower().endswith(IMAGE_EXTENSIONS)), key=lambda entry: entry.name)
+        for entry in images:
+            yield subfolder, entry, os.path.join(text_subdir, os.path.splitext(entry.name)[0] + ".txt")
+
+
+def file_signature(path, stat=None):
+    """
+    (mtime_ns, size) of a file, None if it does not exist
+    """
+    try:
+        stat = stat or os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def content_hash(image_path, text_content):
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(b"\0" + text_content.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_text(text_filepath):
+    if os.path.exists(text_filepath):
+        with open(text_filepath, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    return ""
+
+
+def build_task(subfolder, filename, text_content, preview_width=None, preview_format="webp"):
+    task_id = os.path.splitext(filename)[0]
+    image_url = f"http://{SERVER_IP}:{PORT}/images/{subfolder}/{filename}"
+    prefix, point_list, conclusion = parse_text(text_content)
+
+    task_data = {"image": image_url, "original_image": image_url, "task_id": task_id}
+    if preview_width:
+        task_data["image"] = f"{image_url}?w={preview_width}&fmt={preview_format}"
+    task_data["original_link"] = f'<a href="{image_url}" target="_blank">Open original image</a>'
+    if prefix:
+        task_data["prefix"] = prefix
+    task_data["points"] = list()
+    for idx, pt in enumerate(point_list):
+        task_data["points"].append({"value": pt})
+    if conclusion:
+        task_data["conclusion"] = conclusion
+    else:
+        task_data["conclusion"] = "No conclusion"
+    return {"data": task_data}
+
+
+def process_image(item, state, args):
+    """
+    Build the task of one image. In incremental mode, returns (key, state entry, task) where task is None if
+    the image and its text are unchanged since the last export. Unchanged file signatures skip all reads.
+    """
+    subfolder, entry, text_filepath = item
+    key = f"{subfolder}/{entry.name}"
+    signature = [file_signature(entry.path, entry.stat()), file_signature(text_filepath)]
+
+    previous = state.get(key)
+    if previous and previous["signature"] == signature:
+        return key, previous, None
+
+    text_content = read_text(text_filepath)
+    record = {"signature": signature}
+    if args.incremental:
+        record["hash"] = content_hash(entry.path, text_content)
+        if previous and previous["hash"] == record["hash"]:
+            return key, record, None
+    return key, record, build_task(subfolder, entry.name, text_content, args.preview_width, args.preview_format)
+
+
+def write_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def chunk_paths(output_path, num_chunks, run_id=None):
+    stem, extension = os.path.splitext(output_path)
+    run = f"_run{run_id:03d}" if run_id is not None else ""
+    return [f"{stem}{run}_part{i:03d}{extension or '.json'}" for i in range(num_chunks)]
 
-def parse_text(text):
-    text = text.strip()
-    
-    sections = re.split(r"<begin_of_point>", text)
-    prefix = sections[0].strip() if sections[0] else None
-    
-    points = []
-    conclusion = None
-    
-    for section in sections[1:]:
-        parts = section.split("<end_of_point>", 1)
-        if len(parts) == 2:
-            points.append(parts[0].strip())
-            conclusion = parts[1].strip() if parts[1] else None
-        else:
-            points.append(parts[0].strip())
-    
-    return prefix, points, conclusion
 
 
 if __name__ =='__main__':
@@ -33,46 +118,46 @@ if __name__ =='__main__':
     parser.add_argument("--image_dir", default="generated_images", help="Path to the folder containing images.")
     parser.add_argument("--text_dir", default="generated_annotation_high_level_revised_manual", help="Path to the folder where high-level text files are stored.")
     parser.add_argument("--output_path", default="labelstudio_tasks.json", help="Path to the output JSON file for label-studio labeling.")
+    parser.add_argument("--preview_width", type=int, default=None, help="Show images resized to this width (served by label_studio_server_init.py), the original stays linked in each task.")
+    parser.add_argument("--preview_format", default="webp", choices=["webp", "jpeg", "png"], help="Format of the preview images.")
+    parser.add_argument("--incremental", action="store_true", help="Only export tasks whose image or text changed since the last incremental run.")
+    parser.add_argument("--state_file", default=None, help="State of the incremental export (default: <output_path>.state.json).")
+    parser.add_argument("--chunk_size", type=int, default=0, help="Split tasks into JSON files of at most this many tasks, which can be imported in parallel (0 writes a single file).")
+    parser.add_argument("--num_threads", type=int, default=8, help="Threads reading images and annotation texts.")
     args = parser.parse_args()
 
 
     image_dir = args.image_dir
     text_dir = args.text_dir
     output_path = args.output_path
+    state_file = args.state_file or output_path + ".state.json"
+
+    state = {"runs": 0, "tasks": {}}
+    if args.incremental and os.path.exists(state_file):
+        with open(state_file, "r", encoding="utf-8") as f:
+            state = json.load(f)
 
     tasks = []
+    new_state = {}
+    items = scan_images(image_dir, text_dir)
+    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+        for key, record, task in executor.map(lambda item: process_image(item, state["tasks"], args), items):
+            new_state[key] = record
+            if task is not None:
+                tasks.append(task)
 
-    for subfolder in sorted(os.listdir(image_dir)):
-        image_subdir = os.path.join(image_dir, subfolder)
-        text_subdir = os.path.join(text_dir, subfolder)
-        if not os.path.isdir(image_subdir) or not os.path.isdir(text_subdir):
-            continue
-        for filename in sorted(os.listdir(image_subdir)):
-            if filename.endswith(".png"):
-                task_id = filename.replace(".png", "")
-                image_url = f"http://{SERVER_IP}:{PORT}/images/{subfolder}/{filename}"
-                text_filename = filename.replace(".png", ".txt")
-                text_filepath = os.path.join(text_subdir, text_filename)
-                if os.path.exists(text_filepath):
-                    with open(text_filepath, "r", encoding="utf-8") as f:
-                        text_content = f.read().strip()
-                else:
-                    text_content = ""
-                prefix, point_list, conclusion = parse_text(text_content)
-                
-                task_data = {"image": image_url, "task_id": task_id}
-                if prefix:
-                    task_data["prefix"] = prefix
-                task_data["points"] = list()
-                for idx, pt in enumerate(point_list):
-                    task_data["points"].append({"value": pt})
-                if conclusion:
-                    task_data["conclusion"] = conclusion
-                else:
-                    task_data["conclusion"] = "No conclusion"
-                tasks.append({"data": task_data})
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(tasks, f, indent=4, ensure_ascii=False)
-
-    print(f"{output_path} generated, {len(tasks)} tasks in total.")
+    if args.chunk_size > 0:
+        chunks = [tasks[i:i + args.chunk_size] for i in range(0, len(tasks), args.chunk_size)]
+        # every incremental run gets its own chunk files, so earlier imports are never overwritten
+        paths = chunk_paths(output_path, len(chunks), state["runs"] + 1 if args.incremental else None)
+        for path, chunk in zip(paths, chunks):
+            write_json(path, chunk)
+        print(f"{len(chunks)} chunk files generated ({', '.join(paths[:3])}{', ...' if len(paths) > 3 else ''}), {len(tasks)} tasks in total.")
+    else:
+        write_json(output_path, tasks)
+        print(f"{output_path} generated, {len(tasks)} tasks in total.")
+
+    if args.incremental:
+        # images that disappeared are dropped, so they are exported again if they come back
+        write_json(state_file, {"runs": state["runs"] + 1, "tasks": new_state})
+        print(f"{len(tasks)} new or changed of {len(new_state)} images, state saved to {state_file}")
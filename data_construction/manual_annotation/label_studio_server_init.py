@@ -1,18 +1,308 @@
-from flask import Flask, send_from_directory
+import os
+import gzip
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Flask, abort, request, send_file, send_from_directory
 from flask_cors import CORS
+from werkzeug.security import safe_join
 
 from utils.constants import *
 
-app = Flask(__name__)
-CORS(app)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+IMAGE_MAX_AGE = 365 * 24 * 3600 # images never change under the same content hash, so browsers may keep them for a year
+TEXT_CACHE_SIZE = 1024 # number of compressed annotation texts kept in memory
+PREVIEW_FORMATS = {"webp": "WEBP", "jpeg": "JPEG", "png": "PNG"} # ?fmt= value -> PIL format of resized previews
+PREVIEW_MIN_WIDTH, PREVIEW_MAX_WIDTH = 16, 4096 # accepted ?w= range, larger images are never upscaled
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve images and annotation texts for Label Studio')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='host to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--image_root', type=str, default=IMAGE_ROOT, help='folder served under /images/')
+    parser.add_argument('--annotation_root', type=str, default=ANNOTATION_ROOT, help='folder served under /texts/')
+    parser.add_argument('--production', action='store_true', help='serve with strong ETags, long Cache-Control for images, compressed texts and a threaded server')
+    parser.add_argument('--threads', type=int, default=16, help='worker threads of the production server')
+    parser.add_argument('--preview_cache_dir', type=str, default='preview_cache', help='folder storing resized previews requested with /images/<path>?w=...&fmt=...')
+    parser.add_argument('--preview_cache_gb', type=float, default=2, help='size limit of the preview cache, least recently used previews are evicted')
+    parser.add_argument('--preview_workers', type=int, default=4, help='processes resizing and encoding previews')
+    return parser.parse_args()
+
+
+class ContentHashCache:
+    """
+    Strong ETags from the sha256 of file contents. Hashes are cached by (path, mtime, size), so every file is
+    read once until it changes.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def etag(self, path, stat):
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        etag = digest.hexdigest()[:32]
+        with self.lock:
+            self.hashes[path] = (key, etag)
+        return etag
+
+
+class CompressedTextCache:
+    """
+    LRU cache of compressed annotation texts keyed by (path, mtime, size, encoding).
+    """
+
+    def __init__(self, max_size=TEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, stat, encoding):
+        key = (path, stat.st_mtime_ns, stat.st_size, encoding)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        with open(path, "rb") as f:
+            data = f.read()
+        etag = hashlib.sha256(data).hexdigest()[:32]
+        if encoding == "br":
+            data = brotli.compress(data, quality=5)
+        elif encoding == "gzip":
+            data = gzip.compress(data, compresslevel=6)
+        entry = (data, f"{etag}-{encoding}" if encoding else etag)
+
+        with self.lock:
+            self.entries[key] = entry
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+def make_preview(source_path, preview_path, width, fmt):
+    """
+    resize an image to at most `width` pixels wide (0 keeps the size), encode it in `fmt` and write it atomically
+    """
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        if width and image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            # draft lets JPEG decoding skip straight to a smaller scale
+            image.draft("RGB", (width, height))
+            image = image.resize((width, height), Image.LANCZOS)
+        if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        tmp_path = preview_path + ".tmp"
+        save_kwargs = {"webp": dict(quality=80, method=4), "jpeg": dict(quality=85, optimize=True), "png": dict(optimize=True)}[fmt]
+        image.save(tmp_path, format=PREVIEW_FORMATS[fmt], **save_kwargs)
+    os.replace(tmp_path, preview_path)
+    return os.path.getsize(preview_path)
+
+
+class PreviewCache:
+    """
+    Size-bounded disk cache of resized previews. Previews are keyed by the content hash of the source image,
+    the width and the format, generated once in a process pool (concurrent requests of the same preview wait
+    for the same job) and evicted least recently used first. The modification time of a preview file records
+    its last use, so the eviction order survives restarts.
+    """
+
+    def __init__(self, cache_dir, max_bytes, num_workers=4):
+        # send_file resolves relative paths against the app root, not the working directory
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.executor = ProcessPoolExecutor(max_workers=num_workers)
+        self.lock = threading.Lock()
+        self.in_flight = {}
 
-@app.route('/images/<path:filename>')
-def serve_image(filename):
-    return send_from_directory(IMAGE_ROOT, filename)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and not entry.name.endswith(".tmp")]
+        self.entries = OrderedDict(
+            (entry.name, entry.stat().st_size) for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime)
+        )
+        self.total_bytes = sum(self.entries.values())
+
+    def get(self, source_path, source_etag, width, fmt):
+        """
+        path and ETag of the preview, generating it on a cache miss
+        """
+        key = hashlib.sha256(f"{source_etag}:{width}:{fmt}".encode()).hexdigest()[:32]
+        name = f"{key}.{fmt}"
+        path = os.path.join(self.cache_dir, name)
+
+        with self.lock:
+            if name in self.entries and os.path.exists(path):
+                self.entries.move_to_end(name)
+                os.utime(path)
+                return path, key
+            future = self.in_flight.get(name)
+            if future is None:
+                future = self.executor.submit(make_preview, source_path, path, width, fmt)
+                self.in_flight[name] = future
+
+        try:
+            size = future.result()
+        except Exception:
+            # a failed preview is retried on the next request
+            with self.lock:
+                self.in_flight.pop(name, None)
+            raise
+        with self.lock:
+            if self.in_flight.pop(name, None) is not None:
+                self.entries[name] = size
+                self.total_bytes += size
+                self.evict()
+        return path, key
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+
+def preview_args():
+    """
+    (width, format) of a preview request, None if the original image is requested
+    """
+    width, fmt = request.args.get("w"), request.args.get("fmt")
+    if width is None and fmt is None:
+        return None
+    try:
+        width = int(width or 0)
+    except ValueError:
+        abort(400)
+    fmt = (fmt or "webp").lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in PREVIEW_FORMATS or (width and not PREVIEW_MIN_WIDTH <= width <= PREVIEW_MAX_WIDTH):
+        abort(400)
+    return width, fmt
+
+
+def resolve_file(root, filename):
+    """
+    absolute path and stat of a file below the absolute folder root, aborting with 404 for missing files and paths leaving root
+    """
+    path = safe_join(root, filename)
+    if path is None:
+        abort(404)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        abort(404)
+    if not os.path.isfile(path):
+        abort(404)
+    return path, stat
+
+
+def preferred_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def create_app(image_root=IMAGE_ROOT, annotation_root=ANNOTATION_ROOT, production=False, preview_cache=None):
+    # send_from_directory resolves relative folders against the app root, so both modes use absolute paths
+    image_root, annotation_root = os.path.abspath(image_root), os.path.abspath(annotation_root)
+    app = Flask(__name__)
+    CORS(app)
+    content_hashes = ContentHashCache()
+
+    def serve_preview(filename, width, fmt):
+        path, stat = resolve_file(image_root, filename)
+        preview_path, etag = preview_cache.get(path, content_hashes.etag(path, stat), width, fmt)
+        response = send_file(preview_path, mimetype=f"image/{fmt}", etag=etag, conditional=True, max_age=IMAGE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    if not production:
+        @app.route('/images/<path:filename>')
+        def serve_image(filename):
+            preview = preview_args() if preview_cache else None
+            if preview:
+                return serve_preview(filename, *preview)
+            return send_from_directory(image_root, filename)
+
+        @app.route('/texts/<path:filename>')
+        def serve_text(filename):
+            return send_from_directory(annotation_root, filename)
+
+        return app
+
+    text_cache = CompressedTextCache()
+
+    @app.route('/images/<path:filename>')
+    def serve_image(filename):
+        preview = preview_args() if preview_cache else None
+        if preview:
+            return serve_preview(filename, *preview)
+
+        path, stat = resolve_file(image_root, filename)
+        # send_file answers If-None-Match / If-Modified-Since with 304 and Range requests with 206
+        response = send_file(path, etag=content_hashes.etag(path, stat), conditional=True, max_age=IMAGE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    @app.route('/texts/<path:filename>')
+    def serve_text(filename):
+        path, stat = resolve_file(annotation_root, filename)
+        encoding = preferred_encoding()
+        data, etag = text_cache.get(path, stat, encoding)
+
+        response = app.response_class(data, mimetype="application/json" if path.endswith(".json") else "text/plain")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        # annotation texts are revised during labeling, so clients revalidate them with the ETag
+        response.cache_control.no_cache = True
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+    return app
 
-@app.route('/texts/<path:filename>')
-def serve_text(filename):
-    return send_from_directory(ANNOTATION_ROOT, filename)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=PORT)
+    args = parse_args()
+    preview_cache = PreviewCache(args.preview_cache_dir, int(args.preview_cache_gb * 1024 ** 3), args.preview_workers)
+    app = create_app(args.image_root, args.annotation_root, args.production, preview_cache)
+
+    if not args.production:
+        app.run(host=args.host, port=args.port)
+    else:
+        try:
+            from waitress import serve
+        except ImportError:
+            print("waitress is not installed, falling back to the threaded Werkzeug server")
+            app.run(host=args.host, port=args.port, threaded=True)
+        else:
+            serve(app, host=args.host, port=args.port, threads=args.threads)
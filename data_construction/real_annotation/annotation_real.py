@@ -1,6 +1,7 @@
 import os
 import argparse
 from utils.gpt4o import gpt4o_response
+from utils.utils import filter_skipped, load_rejected_images
 from tqdm import tqdm
 import concurrent.futures
 
@@ -86,7 +87,7 @@ def process_image(image_path, output_folder, prompt_template):
     except Exception as e:
         print(f"Error processing {output_path}: {e}")
 
-def process_images_parallel(input_folder, output_folder, prompt_template, max_workers=None):
+def process_images_parallel(input_folder, output_folder, prompt_template, max_workers=None, skip_list=None, filter_manifest=None):
     """
     Process images in parallel from the input folder.
 
@@ -95,6 +96,8 @@ def process_images_parallel(input_folder, output_folder, prompt_template, max_wo
         output_folder: Path to the folder where output text files will be saved.
         prompt_template: Prompt template for analysis.
         max_workers: Maximum number of worker threads. If None, defaults to the number of CPU cores.
+        skip_list: Optional file listing image paths to skip, e.g. near-duplicates.
+        filter_manifest: Optional manifest of image_screening.py, rejected images are not sent to the API.
     """
     # Ensure the output folder exists
     if not os.path.exists(output_folder):
@@ -106,6 +109,15 @@ def process_images_parallel(input_folder, output_folder, prompt_template, max_wo
         if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
             image_paths.append(os.path.join(input_folder, filename))
 
+    image_paths = filter_skipped(image_paths, skip_list)
+
+    # images rejected by data_construction/real_annotation/image_screening.py are not worth an API call
+    rejected = load_rejected_images(filter_manifest)
+    if rejected:
+        num_images = len(image_paths)
+        image_paths = [path for path in image_paths if os.path.abspath(path) not in rejected]
+        print(f"Skipping {num_images - len(image_paths)} images rejected in {filter_manifest}")
+
     # Use a thread pool to process images in parallel
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         list(tqdm(executor.map(process_image, image_paths, [output_folder] * len(image_paths), [prompt_template] * len(image_paths)),
@@ -116,9 +128,11 @@ def main():
     parser.add_argument("--input_folder", default="real_images", help="Path to the folder containing images.")
     parser.add_argument("--output_folder", default="annotation_real_high_level", help="Path to the folder where output text files will be saved.")
     parser.add_argument("--max_workers", type=int, default=4, help="Maximum number of worker threads. (Default: number of CPU cores)")
+    parser.add_argument("--skip_list", default=None, help="File listing image paths to skip, e.g. near-duplicates found by data_construction/image_dedup.py.")
+    parser.add_argument("--filter_manifest", default=None, help="Manifest written by data_construction/real_annotation/image_screening.py, rejected images are skipped.")
     args = parser.parse_args()
 
-    process_images_parallel(args.input_folder, args.output_folder, prompt_template, args.max_workers)
+    process_images_parallel(args.input_folder, args.output_folder, prompt_template, args.max_workers, args.skip_list, args.filter_manifest)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,8 @@
 import os
+import time
 import argparse
 from utils.gpt4o import gpt4o_response
+from utils.utils import filter_skipped, parse_text
 from tqdm import tqdm
 import concurrent.futures
 
@@ -36,8 +38,43 @@ Use this structure to process and merge the provided annotations while ensuring
 
 
 
+# fixed low-level point of every real image, the example point of prompt_template without its scene-specific objects
+REAL_LOW_LEVEL_POINT = "The image shows no low-level errors related to texture or lighting. Textures are clear and detailed, with no blurriness or unnatural patterns. The lighting is well-balanced, avoiding issues like harsh shadows or inconsistent tones. Reflections on surfaces also appear realistic, contributing to a polished and artifact-free presentation."
+REAL_CONCLUSION = "**Conclusion**: Based on the combination of low-level and high-level errors identified, the image is judged to be \\boxed{real}."
+FILTER_MARKER = "<to_be_filtered>" # kept at the end so that final_json_create.py still drops the image
 
-def process_image(image_path, high_level_folder, output_folder, prompt_template):
+
+def structure_annotation(high_level_annotation):
+    """
+    Wrap the points of a high-level annotation into the final layout without calling the API. Returns None if
+    the annotation has no points or malformed markers, so that it is structured by the LLM instead.
+    """
+    text = high_level_annotation.strip()
+    to_be_filtered = text.endswith(FILTER_MARKER)
+    if to_be_filtered:
+        text = text[:-len(FILTER_MARKER)].rstrip()
+
+    _, points, _ = parse_text(text)
+    points = [point for point in points if point]
+    if not points or any("<begin_of_" in point or "<end_of_" in point for point in points):
+        return None
+
+    sections = [
+        "<begin_of_low_level_errors>",
+        f"<begin_of_point>\n{REAL_LOW_LEVEL_POINT}\n<end_of_point>",
+        "<end_of_low_level_errors>",
+        "",
+        "<begin_of_high_level_errors>",
+        *[f"<begin_of_point>\n{point}\n<end_of_point>" for point in points],
+        "<end_of_high_level_errors>",
+        "",
+        REAL_CONCLUSION,
+    ]
+    structured = "\n".join(sections)
+    return f"{structured}\n{FILTER_MARKER}" if to_be_filtered else structured
+
+
+def process_image(image_path, high_level_folder, output_folder, prompt_template, structurer="local"):
     """
     Process a single image, call the GPT-4 API, and save the result to a file.
     """
@@ -60,6 +97,14 @@ def process_image(image_path, high_level_folder, output_folder, prompt_template)
     with open(high_level_path, "r") as f:
         high_level_annotation = f.read()
 
+    if structurer == "local":
+        structured = structure_annotation(high_level_annotation)
+        if structured is not None:
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(structured)
+            return "local"
+        print(f"Could not structure {high_level_path} locally, falling back to the API")
+
     prompt = prompt_template.format(high_level_annotation=high_level_annotation)
 
     # Call the GPT-4 API
@@ -71,11 +116,12 @@ def process_image(image_path, high_level_folder, output_folder, prompt_template)
             f.write(response)
 
         print(f"Processed {image_path}, result saved to {output_path}")
+        return "llm"
 
     except Exception as e:
         print(f"Error processing {output_path}: {e}")
 
-def process_images_parallel(input_folder, high_level_folder, output_folder, prompt_template, max_workers=None):
+def process_images_parallel(input_folder, high_level_folder, output_folder, prompt_template, max_workers=None, skip_list=None, structurer="local"):
 
     # Ensure the output folder exists
     if not os.path.exists(output_folder):
@@ -87,26 +133,36 @@ def process_images_parallel(input_folder, high_level_folder, output_folder, prom
         if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
             image_paths.append(os.path.join(input_folder, filename))
 
+    image_paths = filter_skipped(image_paths, skip_list)
+
     # Use a thread pool to process images in parallel
+    start = time.perf_counter()
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        list(tqdm(
+        methods = list(tqdm(
             executor.map(process_image, image_paths,  
             [high_level_folder] * len(image_paths), 
             [output_folder] * len(image_paths),
-            [prompt_template] * len(image_paths)), 
+            [prompt_template] * len(image_paths),
+            [structurer] * len(image_paths)), 
             total=len(image_paths), 
             desc="Processing images"
             ))
 
+    elapsed = time.perf_counter() - start
+    num_local, num_llm = methods.count("local"), methods.count("llm")
+    print(f"{num_local} annotations structured locally, {num_llm} by the API in {elapsed:.1f}s")
+
 def main():
     parser = argparse.ArgumentParser(description="Process images with GPT-4 and a prompt template (parallel processing).")
     parser.add_argument("--input_folder", default="real_images", help="Path to the folder containing images.")
     parser.add_argument("--high_level_folder", default="real_annotation_high_level", help="Path to the folder where output text files will be saved.")
     parser.add_argument("--output_folder", default="real_annotation_final", help="Path to the folder where output text files will be saved.")
     parser.add_argument("--max_workers", type=int, default=4, help="Maximum number of worker threads. (Default: number of CPU cores)")
+    parser.add_argument("--skip_list", default=None, help="File listing image paths to skip, e.g. near-duplicates found by data_construction/image_dedup.py.")
+    parser.add_argument("--structurer", default="local", choices=["local", "llm"], help="Structure annotations with local rules (falling back to the API for unparseable ones) or always with the API.")
     args = parser.parse_args()
 
-    process_images_parallel(args.input_folder, args.high_level_folder, args.output_folder, prompt_template, args.max_workers)
+    process_images_parallel(args.input_folder, args.high_level_folder, args.output_folder, prompt_template, args.max_workers, args.skip_list, args.structurer)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import json
+import argparse
+import concurrent.futures
+
+from tqdm import tqdm
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+TAIL_SIZE = 64 # bytes read from the end of a file to detect truncation
+PNG_END = b"IEND\xaeB`\x82" # IEND chunk type and CRC closing every PNG
+JPEG_END = b"\xff\xd9" # EOI marker closing every JPEG
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Screen real images from their headers before annotation and write a filter manifest.")
+    parser.add_argument("--input_folder", default="real_images", help="Path to the folder containing images.")
+    parser.add_argument("--manifest", default="real_images_manifest.jsonl", help="Output JSONL with the metadata and screening result of every image.")
+    parser.add_argument("--min_side", type=int, default=256, help="Minimum width and height in pixels.")
+    parser.add_argument("--max_pixels", type=int, default=50_000_000, help="Maximum number of pixels.")
+    parser.add_argument("--max_aspect_ratio", type=float, default=3.0, help="Maximum ratio of the longer to the shorter side.")
+    parser.add_argument("--modes", nargs="+", default=["1", "L", "LA", "P", "PA", "RGB", "RGBA", "CMYK", "YCbCr", "I", "I;16", "F"],
+                        help="Accepted PIL image modes, e.g. remove 16-bit (I;16) or floating-point (F) images.")
+    parser.add_argument("--max_workers", type=int, default=16, help="Maximum number of worker threads reading headers.")
+    return parser.parse_args()
+
+
+def is_truncated(path, image_format):
+    """
+    check the end marker of PNG and JPEG files and the RIFF length of WebP files, which a partial download lacks
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - TAIL_SIZE))
+        tail = f.read()
+        if image_format == "WEBP":
+            f.seek(4)
+            riff_size = int.from_bytes(f.read(4), "little")
+            return size < riff_size + 8
+
+    # some writers pad files after the end marker
+    tail = tail.rstrip(b"\x00\r\n ")
+    if image_format == "PNG":
+        return not tail.endswith(PNG_END)
+    if image_format == "JPEG":
+        return not tail.endswith(JPEG_END)
+    return False
+
+
+def screen_image(image_path, args):
+    """
+    read the header of an image (without decoding pixels) and check it against the limits
+    """
+    from PIL import Image
+
+    record = {"path": os.path.abspath(image_path), "reasons": []}
+    try:
+        record["size_bytes"] = os.path.getsize(image_path)
+        with Image.open(image_path) as image:
+            record.update(width=image.width, height=image.height, mode=image.mode, format=image.format)
+        truncated = is_truncated(image_path, record["format"])
+    except Exception as e:
+        # a file failing to open or to read (e.g. removed or unreadable) is rejected without stopping the screening
+        record["reasons"].append(f"unreadable: {type(e).__name__}: {e}")
+        record["accepted"] = False
+        return record
+
+    width, height = record["width"], record["height"]
+    if truncated:
+        record["reasons"].append("truncated")
+    if min(width, height) < args.min_side:
+        record["reasons"].append(f"too small: {width}x{height}")
+    if width * height > args.max_pixels:
+        record["reasons"].append(f"too large: {width}x{height}")
+    if max(width, height) > args.max_aspect_ratio * max(min(width, height), 1):
+        record["reasons"].append(f"extreme aspect ratio: {width}x{height}")
+    if record["mode"] not in args.modes:
+        record["reasons"].append(f"unsupported mode: {record['mode']}")
+
+    record["accepted"] = not record["reasons"]
+    return record
+
+
+def main():
+    args = parse_args()
+
+    image_paths = sorted(
+        os.path.join(args.input_folder, filename) for filename in os.listdir(args.input_folder)
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        records = list(tqdm(executor.map(screen_image, image_paths, [args] * len(image_paths)),
+                            total=len(image_paths), desc="Screening images"))
+
+    with open(args.manifest, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    rejected = [record for record in records if not record["accepted"]]
+    reasons = {}
+    for record in rejected:
+        for reason in record["reasons"]:
+            reason = reason.split(":")[0]
+            reasons[reason] = reasons.get(reason, 0) + 1
+    print(f"{len(records) - len(rejected)} of {len(records)} images accepted, manifest saved to {args.manifest}")
+    for reason, count in sorted(reasons.items(), key=lambda item: -item[1]):
+        print(f"- {reason}: {count}")
+
+
+if __name__ == "__main__":
+    main()
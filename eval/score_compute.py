@@ -1,20 +1,28 @@
-import numpy as np
+import os
 import json
+import numpy as np
 from tqdm import tqdm
 from argparse import ArgumentParser
-
-import evaluate
-from sentence_transformers import SentenceTransformer, util
+from functools import lru_cache
 
 from utils.gpt4o import gpt4o_response
+from utils.embedding import EMBEDDING_BACKENDS, PARITY_TOLERANCE, load_embedding_model, cosine_score_matrix, parity_check
 from utils.utils import *
 
 
 def parse_args():
     parser = ArgumentParser(description="Compute scores of evaluation metrics")
-    parser.add_argument("--annotation_file", default="benchmark_test_data_result.json", help="Path to the json file containing ground truth and generated text")
-    parser.add_argument("--metrics", default="sentence_transformer", help="Path to the folder where output text files will be saved.",
-                        choices=["sentence_transformer, bleu@1, bleu@2, bleu@3, bleu@4, rouge, meteor, gpt_4o"])
+    parser.add_argument("--annotation_file", default="benchmark_test_data_result.json", help="Path to the json or jsonl file containing ground truth and generated text")
+    parser.add_argument("--metrics", default="sentence_transformer", help="Metric used to compute the pairwise similarity between points.",
+                        choices=["sentence_transformer", "bleu@1", "bleu@2", "bleu@3", "bleu@4", "rouge", "meteor", "gpt_4o"])
+    parser.add_argument("--embedding_backend", default="torch", choices=EMBEDDING_BACKENDS, help="Inference backend of the sentence_transformer metric.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of CPU threads used by the embedding backend.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size used by the embedding backend.")
+    parser.add_argument("--threshold", type=float, default=0.7, help="Score threshold for a point to count as matched in richness and halluciation rate.")
+    parser.add_argument("--score_dump", default=None, help="Optional JSONL file storing the matched score list, M and N of every sample for eval/threshold_sweep.py.")
+    parser.add_argument("--parity_check", type=int, default=0, help="Compare cosine scores of the first N samples against the fp32 PyTorch reference model.")
+    parser.add_argument("--output_file", default="tmp_eval_result.txt", help="Path to the text file where averaged scores will be saved.")
+    parser.add_argument("--flush_every", type=int, default=1000, help="Write running averages to output_file every N scored samples (0 to only write at the end).")
     args = parser.parse_args()
 
     return args
@@ -45,8 +53,16 @@ def get_pairwise_score(point_gt, point_gen):
         return 0.0
     
 
+@lru_cache(maxsize=None)
+def load_scorer(metric_name):
+    # evaluate is only imported when an NLP metric is selected, and each metric is loaded once per run
+    import evaluate
+
+    return evaluate.load(metric_name)
+
+
 def compute_score_matrix(list1, list2, metric_name="bleu", bleu_order=None):
-    scorer = evaluate.load(metric_name)
+    scorer = load_scorer(metric_name)
     M, N = len(list1), len(list2)
     score_matrix = np.zeros((M, N))
 
@@ -68,7 +84,13 @@ def compute_score_matrix(list1, list2, metric_name="bleu", bleu_order=None):
 
 
 
-def compute_metrics(label_gt, label_gen, points_gt, points_gen, metrics, threshold=0.7):
+def compute_score_list(label_gt, label_gen, points_gt, points_gen, metrics, embedding_model=None, batch_size=32):
+    """
+    compute the label accuracy and the matched score of every ground truth point
+
+    :return: None if there is no ground truth point, otherwise (accuracy, score_list, M, N). score_list is None
+             when the result does not depend on point matching (wrong label, or a correctly detected real image)
+    """
 
     assert label_gt.lower() in ["ai-generated", "real"] and label_gen.lower() in ["ai-generated", "real"]
 
@@ -80,9 +102,9 @@ def compute_metrics(label_gt, label_gen, points_gt, points_gen, metrics, thresho
     accuracy = (label_gt.lower() == label_gen.lower())
 
     if not accuracy:
-        return 0.0, 0.0, 0.0, 1.0
+        return 0.0, None, M, N
     elif accuracy and label_gt.lower() == "real":
-        return 1.0, 1.0, 1.0, 0.0
+        return 1.0, None, M, N
 
     accuracy = 1.0
 
@@ -95,10 +117,8 @@ def compute_metrics(label_gt, label_gen, points_gt, points_gen, metrics, thresho
     
 
     # Sentence Transformers
-    elif metrics == "sentence_transformers":
-        embedding1 = model.encode(points_gt, convert_to_tensor=True)
-        embedding2 = model.encode(points_gen, convert_to_tensor=True)
-        score_matrix = util.cos_sim(embedding1, embedding2).cpu().numpy()
+    elif metrics in ["sentence_transformer", "sentence_transformers"]:
+        score_matrix = cosine_score_matrix(embedding_model, points_gt, points_gen, batch_size)
 
     # NLP metrics (BLEU, ROUGE, METEOR)
     elif metrics in ["bleu@1", "bleu@2", "bleu@3", "bleu@4", "rouge", "meteor"]:
@@ -119,6 +139,16 @@ def compute_metrics(label_gt, label_gen, points_gt, points_gen, metrics, thresho
         score_matrix[:, j_max] = 0
         k += 1
 
+    return accuracy, score_list, M, N
+
+
+def metrics_from_score_list(accuracy, score_list, M, N, threshold=0.7):
+    """
+    derive accuracy, match score, richness score and halluciation rate from a matched score list
+    """
+    if score_list is None:
+        return (0.0, 0.0, 0.0, 1.0) if accuracy == 0.0 else (1.0, 1.0, 1.0, 0.0)
+
     # compute match score and richness score
     match_score = np.mean(score_list)
     richness_score = np.sum(score_list >= threshold) / M
@@ -130,64 +160,103 @@ def compute_metrics(label_gt, label_gen, points_gt, points_gen, metrics, thresho
     return accuracy, match_score, richness_score, halluciation_rate
 
 
+def compute_metrics(label_gt, label_gen, points_gt, points_gen, metrics, threshold=0.7, embedding_model=None, batch_size=32):
 
-if __name__ == "__main__":
-
-    args = parse_args()
-
-    with open(args.annotation_file, 'r') as f:
-        annotations = json.load(f)
-
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-
-    total_accuracy, total_match_score, total_richness_score, total_halluciation_rate = [], [], [], []
+    scores = compute_score_list(label_gt, label_gen, points_gt, points_gen, metrics, embedding_model, batch_size)
+    if scores is None:
+        return None
 
-    for annotation in tqdm(annotations):
-        image_path = annotation["image_path"]
-        ground_truth = annotation["ground_truth"]
-        generated = annotation["generated"]
-        label = annotation["label"]
+    return metrics_from_score_list(*scores, threshold=threshold)
 
-        # extract high-level errors
-        ground_truth_high_level = extract_content_by_regex(ground_truth, start_marker="<begin_of_high_level_errors>", end_marker="<end_of_high_level_errors>")
-        generated_high_level = extract_content_by_regex(generated, start_marker="<begin_of_high_level_errors>", end_marker="<end_of_high_level_errors>")
 
-        ground_truth_high_level = ground_truth_high_level if ground_truth_high_level else ground_truth
-        generated_high_level = generated_high_level if generated_high_level else generated
 
-        _, points_gt, _ = parse_text(ground_truth_high_level)
-        _, points_gen, _ = parse_text(generated_high_level)
+def write_results(output_file, totals, num_samples):
+    """
+    write the running averages to the output file, replacing it atomically
+    """
+    averages = {name: (value / num_samples if num_samples else 0.0) for name, value in totals.items()}
 
-        label_gt = get_boxed_content(ground_truth)
-        label_gen = get_boxed_content(generated)
+    tmp_path = output_file + ".tmp"
+    with open(tmp_path, "w") as f:
+        for name, value in averages.items():
+            f.write(f"avg_{name}:{value}\n")
+        f.write(f"num_samples:{num_samples}\n")
+    os.replace(tmp_path, output_file)
 
-        label_gt = label_gt if label_gt else "real"
-        label_gen = label_gen if label_gen else "real"
+    return averages
 
-        results = compute_metrics(label_gt, label_gen, points_gt, points_gen, args.metrics)
-        if results:
-            accuracy, match_score, richness_score, halluciation_rate = results
-            total_match_score.append(match_score)
-            total_richness_score.append(richness_score)
-            total_halluciation_rate.append(halluciation_rate)
-            total_accuracy.append(accuracy)
 
 
-    avg_match_score = sum(total_match_score) / len(total_match_score)
-    avg_richness_score = sum(total_richness_score) / len(total_richness_score)
-    avg_halluciation_rate = sum(total_halluciation_rate) / len(total_halluciation_rate)
-    avg_accuracy = sum(total_accuracy) / len(total_accuracy)
+if __name__ == "__main__":
 
-    print("avg_match_score:", avg_match_score)
-    print("avg_richness_score:", avg_richness_score)
-    print("avg_halluciation_rate:", avg_halluciation_rate)
-    print("avg_accuracy:", avg_accuracy)
+    args = parse_args()
 
-    with open("tmp_eval_result.txt", "w") as f:
-        f.write(f"avg_match_score:{avg_match_score}\n")
-        f.write(f"avg_richness_score:{avg_richness_score}\n")
-        f.write(f"avg_halluciation_rate:{avg_halluciation_rate}\n")
-        f.write(f"avg_accuracy:{avg_accuracy}\n")
+    embedding_model = None
+    if args.metrics == "sentence_transformer":
+        embedding_model = load_embedding_model(args.embedding_backend, num_threads=args.num_threads)
+    parity_pairs = []
+    score_dump = open(args.score_dump, "w") if args.score_dump else None
 
+    # running sums keep memory bounded no matter how large the annotation file is
+    totals = {"match_score": 0.0, "richness_score": 0.0, "halluciation_rate": 0.0, "accuracy": 0.0}
+    num_samples = 0
 
+    for annotation in tqdm(iter_annotations(args.annotation_file)):
+        image_path = annotation["image_path"]
+        ground_truth = annotation["ground_truth"]
+        generated = annotation["generated"]
+        label = annotation["label"]
 
+        # parse high-level error points and labels in a single scan per annotation
+        record_gt = parse_annotation(ground_truth)
+        record_gen = parse_annotation(generated)
+
+        points_gt, points_gen = record_gt.points, record_gen.points
+
+        label_gt = record_gt.label if record_gt.label else "real"
+        label_gen = record_gen.label if record_gen.label else "real"
+
+        if embedding_model is not None and len(parity_pairs) < args.parity_check:
+            parity_pairs.append((points_gt, points_gen))
+
+        scores = compute_score_list(label_gt, label_gen, points_gt, points_gen, args.metrics,
+                                    embedding_model=embedding_model, batch_size=args.batch_size)
+        if scores:
+            accuracy, score_list, M, N = scores
+            if score_dump:
+                score_dump.write(json.dumps({
+                    "image_path": image_path,
+                    "accuracy": accuracy,
+                    "score_list": score_list.tolist() if score_list is not None else None,
+                    "M": M,
+                    "N": N,
+                }) + "\n")
+
+            accuracy, match_score, richness_score, halluciation_rate = metrics_from_score_list(*scores, threshold=args.threshold)
+            totals["match_score"] += match_score
+            totals["richness_score"] += richness_score
+            totals["halluciation_rate"] += halluciation_rate
+            totals["accuracy"] += accuracy
+            num_samples += 1
+
+            if args.flush_every > 0 and num_samples % args.flush_every == 0:
+                write_results(args.output_file, totals, num_samples)
+                if score_dump:
+                    score_dump.flush()
+
+
+    if score_dump:
+        score_dump.close()
+
+    averages = write_results(args.output_file, totals, num_samples)
+
+    for name, value in averages.items():
+        print(f"avg_{name}:", value)
+
+    if parity_pairs:
+        reference_model = load_embedding_model("torch", device="cpu", num_threads=args.num_threads)
+        report = parity_check(embedding_model, reference_model, parity_pairs, args.batch_size)
+        tolerance = PARITY_TOLERANCE[args.embedding_backend]
+        status = "within" if report["max_drift"] <= tolerance else "EXCEEDS"
+        print(f"parity check ({args.embedding_backend} vs torch fp32, {report['num_pairs']} samples): "
+              f"max_drift={report['max_drift']:.6f}, mean_drift={report['mean_drift']:.6f}, {status} tolerance {tolerance}")
@@ -0,0 +1,102 @@
+import csv
+import sys
+import json
+import numpy as np
+from argparse import ArgumentParser
+
+from utils.utils import iter_annotations
+
+
+def parse_args():
+    parser = ArgumentParser(description="Compute richness score and halluciation rate over a grid of thresholds from stored match scores")
+    parser.add_argument("--score_dump", default="score_dump.jsonl", help="Path to the JSONL score dump written by eval/score_compute.py --score_dump")
+    parser.add_argument("--thresholds", default="0.5:0.95:0.05", help="Threshold grid as start:stop:step (inclusive) or a comma-separated list")
+    parser.add_argument("--output", default=None, help="Path to the output table (.csv or .json), printed to stdout if not given")
+    args = parser.parse_args()
+
+    return args
+
+
+def parse_thresholds(spec):
+    if ":" in spec:
+        start, stop, step = (float(v) for v in spec.split(":"))
+        return np.round(np.arange(start, stop + step / 2, step), 10)
+    return np.array([float(v) for v in spec.split(",")])
+
+
+def load_score_dump(path):
+    """
+    load a score dump into padded arrays
+
+    :return: (accuracy, fixed, scores, M, N), where `fixed` marks samples whose metrics do not depend on the
+             threshold and `scores` is a (num_samples, max_M) matrix padded with -inf
+    """
+    accuracy, fixed, score_lists, M, N = [], [], [], [], []
+    for record in iter_annotations(path):
+        accuracy.append(record["accuracy"])
+        fixed.append(record["score_list"] is None)
+        score_lists.append(record["score_list"] or [])
+        M.append(record["M"])
+        N.append(record["N"])
+
+    max_m = max((len(s) for s in score_lists), default=0)
+    scores = np.full((len(score_lists), max(max_m, 1)), -np.inf)
+    for i, score_list in enumerate(score_lists):
+        scores[i, :len(score_list)] = score_list
+
+    return np.array(accuracy, dtype=float), np.array(fixed, dtype=bool), scores, np.array(M, dtype=float), np.array(N, dtype=float)
+
+
+def threshold_sweep(accuracy, fixed, scores, M, N, thresholds):
+    """
+    compute averaged metrics for every threshold at once
+
+    :return: dict of arrays, each with one entry per threshold
+    """
+    # (num_samples, num_thresholds) number of matched points for every threshold
+    matched = (scores[:, :, None] >= thresholds[None, None, :]).sum(axis=1)
+
+    richness = matched / M[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        halluciation = np.where(N[:, None] > 0, 1 - matched / N[:, None], 0.0)
+
+    # wrong labels count as (richness 0, halluciation 1), correctly detected real images as (1, 0)
+    richness = np.where(fixed[:, None], accuracy[:, None], richness)
+    halluciation = np.where(fixed[:, None], 1 - accuracy[:, None], halluciation)
+
+    match_scores = np.where(fixed, accuracy, np.where(np.isfinite(scores), scores, 0.0).sum(axis=1) / M)
+
+    num_thresholds = len(thresholds)
+    return {
+        "threshold": thresholds,
+        "avg_match_score": np.full(num_thresholds, match_scores.mean()),
+        "avg_richness_score": richness.mean(axis=0),
+        "avg_halluciation_rate": halluciation.mean(axis=0),
+        "avg_accuracy": np.full(num_thresholds, accuracy.mean()),
+    }
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    accuracy, fixed, scores, M, N = load_score_dump(args.score_dump)
+    if len(accuracy) == 0:
+        sys.exit(f"No samples found in {args.score_dump}")
+
+    sweep = threshold_sweep(accuracy, fixed, scores, M, N, parse_thresholds(args.thresholds))
+    rows = [{name: float(values[i]) for name, values in sweep.items()} for i in range(len(sweep["threshold"]))]
+
+    if args.output and args.output.endswith(".json"):
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=4)
+    else:
+        f = open(args.output, "w", newline="") if args.output else sys.stdout
+        writer = csv.DictWriter(f, fieldnames=list(sweep.keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+        if args.output:
+            f.close()
+
+    if args.output:
+        print(f"Threshold sweep over {len(accuracy)} samples saved to {args.output}")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import `utils` from the repository root, like running them with PYTHONPATH=.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,115 @@
+import re
+
+import pytest
+
+from utils.utils import parse_annotation, parse_text
+
+
+LOW_START, LOW_END = "<begin_of_low_level_errors>", "<end_of_low_level_errors>"
+HIGH_START, HIGH_END = "<begin_of_high_level_errors>", "<end_of_high_level_errors>"
+
+
+# regex helpers used before the single-pass parser, the reference parse_annotation and parse_text must match
+
+def legacy_parse_text(text):
+    text = text.strip()
+
+    sections = re.split(r"<begin_of_point>", text)
+    prefix = sections[0].strip() if sections[0] else None
+
+    points = []
+    conclusion = None
+
+    for section in sections[1:]:
+        parts = section.split("<end_of_point>", 1)
+        if len(parts) == 2:
+            points.append(parts[0].strip())
+            conclusion = parts[1].strip() if parts[1] else None
+        else:
+            points.append(parts[0].strip())
+
+    return prefix, points, conclusion
+
+
+def legacy_extract_content_by_regex(text, start_marker, end_marker):
+    pattern = re.escape(start_marker) + r"(.*?)" + re.escape(end_marker)
+    match = re.search(pattern, text, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    return None
+
+
+def legacy_get_boxed_content(text):
+    content = re.findall(r"\\boxed\{(.*?)\}", text)
+    if content:
+        return content[0]
+    return None
+
+
+def legacy_parse_annotation(text):
+    low_level = legacy_extract_content_by_regex(text, LOW_START, LOW_END)
+    high_level = legacy_extract_content_by_regex(text, HIGH_START, HIGH_END)
+    prefix, points, conclusion = legacy_parse_text(high_level if high_level else text)
+    return low_level, high_level, prefix, points, conclusion, legacy_get_boxed_content(text)
+
+
+def new_parse_annotation(text):
+    record = parse_annotation(text)
+    return record.low_level, record.high_level, record.prefix, record.points, record.conclusion, record.label
+
+
+EXAMPLE_ANNOTATIONS = {
+    "complete": (
+        "<begin_of_low_level_errors>\n<begin_of_point>\n**Texture Artifact**: the wall is smeared.\n<end_of_point>\n<end_of_low_level_errors>\n\n"
+        "<begin_of_high_level_errors>\n<begin_of_point>\n**Hands and Fingers**: six fingers on the left hand.\n<end_of_point>\n"
+        "<begin_of_point>\n**Shadow Mismatch**: the shadow points toward the sun.\n<end_of_point>\n<end_of_high_level_errors>\n\n"
+        "**Conclusion**: the image is judged to be \\boxed{AI-generated}."
+    ),
+    "real_image": (
+        "<begin_of_low_level_errors>\n<begin_of_point>\nFine details are consistent.\n<end_of_point>\n<end_of_low_level_errors>\n"
+        "<begin_of_high_level_errors>\n<begin_of_point>\nThe scene is coherent.\n<end_of_point>\n<end_of_high_level_errors>\n"
+        "**Conclusion**: \\boxed{real}"
+    ),
+    "points_only": "<begin_of_point>\nfirst point\n<end_of_point>\n<begin_of_point>\nsecond point\n<end_of_point>\ntrailing conclusion",
+    "prefix_and_conclusion": "Some analysis first.\n<begin_of_point>\npoint\n<end_of_point>\nFinal words \\boxed{real}",
+    "missing_end_of_point": "<begin_of_high_level_errors>\n<begin_of_point>\nclosed\n<end_of_point>\n<begin_of_point>\nnever closed\n<end_of_high_level_errors>",
+    "missing_last_end_of_point": "<begin_of_point>\nclosed\n<end_of_point>\n<begin_of_point>\nnever closed \\boxed{AI-generated}",
+    "missing_end_of_section": "<begin_of_low_level_errors>\n<begin_of_point>\nlow\n<end_of_point>\n<begin_of_high_level_errors>\n<begin_of_point>\nhigh\n<end_of_point>\n\\boxed{AI-generated}",
+    "end_markers_without_begin": "text <end_of_point> more <end_of_high_level_errors> \\boxed{real}",
+    "boxed_next_to_markers": "<begin_of_point>\\boxed{real}<end_of_point><begin_of_point>x<end_of_point>\\boxed{AI-generated}",
+    "boxed_inside_point": "<begin_of_high_level_errors><begin_of_point>looks \\boxed{real} here<end_of_point><end_of_high_level_errors>",
+    "empty_boxed": "<begin_of_point>p<end_of_point>\\boxed{}",
+    "multiline_boxed_label": "<begin_of_point>p<end_of_point>\\boxed{AI-\ngenerated}",
+    "empty_high_level_section": (
+        "<begin_of_low_level_errors>\n<begin_of_point>\nlow\n<end_of_point>\n<end_of_low_level_errors>\n"
+        "<begin_of_high_level_errors>\n\n<end_of_high_level_errors>\n<begin_of_point>\noutside\n<end_of_point>\n\\boxed{AI-generated}"
+    ),
+    "blank_high_level_section": "<begin_of_high_level_errors>   <end_of_high_level_errors>",
+    "empty_point": "<begin_of_point><end_of_point><begin_of_point>   <end_of_point>",
+    "repeated_sections": (
+        "<begin_of_high_level_errors><begin_of_point>first<end_of_point><end_of_high_level_errors>"
+        "<begin_of_high_level_errors><begin_of_point>second<end_of_point><end_of_high_level_errors>"
+    ),
+    "no_markers": "The image looks fine. \\boxed{real}",
+    "whitespace_only": " \n\t ",
+    "empty": "",
+}
+
+
+@pytest.mark.parametrize("name", sorted(EXAMPLE_ANNOTATIONS))
+def test_parse_annotation_matches_legacy(name):
+    text = EXAMPLE_ANNOTATIONS[name]
+    assert new_parse_annotation(text) == legacy_parse_annotation(text)
+
+
+@pytest.mark.parametrize("name", sorted(EXAMPLE_ANNOTATIONS))
+def test_parse_text_matches_legacy(name):
+    text = EXAMPLE_ANNOTATIONS[name]
+    assert parse_text(text) == legacy_parse_text(text)
+
+
+def test_parse_annotation_fields():
+    record = parse_annotation(EXAMPLE_ANNOTATIONS["complete"])
+    assert record.label == "AI-generated"
+    assert record.points == ["**Hands and Fingers**: six fingers on the left hand.", "**Shadow Mismatch**: the shadow points toward the sun."]
+    assert record.low_level.startswith("<begin_of_point>")
@@ -0,0 +1,154 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "data_construction"))
+
+import image_generate
+
+
+def worker_options(**overrides):
+    options = dict(
+        batch_size=2,
+        max_batch_size=2,
+        prompt_cache_size=8,
+        prefetch_memory_gb=0,
+        save_threads=1,
+        max_pending_saves=4,
+        image_format="png",
+        compress_level=1,
+        report_file=None,
+        **{name: None for name in image_generate.MEMORY_OPTIONS},
+    )
+    options.update(overrides)
+    return options
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    # spawned workers inherit the environment, so no test ever downloads weights
+    monkeypatch.setenv("HF_HUB_OFFLINE", "1")
+
+
+def write_tiny_tokenizer(folder):
+    """
+    CLIP tokenizer files with a vocabulary of single letters, so no tokenizer has to be downloaded
+    """
+    import json
+    from transformers import CLIPTokenizer
+
+    os.makedirs(folder, exist_ok=True)
+    letters = [chr(c) for c in range(ord("a"), ord("z") + 1)]
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for token in letters + [letter + "</w>" for letter in letters]:
+        vocab[token] = len(vocab)
+    with open(os.path.join(folder, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(folder, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(os.path.join(folder, "vocab.json"), os.path.join(folder, "merges.txt"), model_max_length=16)
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tmp_path_factory):
+    """
+    random-init Stable Diffusion pipeline with tiny UNet, VAE and CLIP text encoder saved to a local folder
+    """
+    import torch
+    pytest.importorskip("transformers")
+    from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        sample_size=16, in_channels=4, out_channels=4, layers_per_block=1, block_out_channels=(32, 64),
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32, attention_head_dim=8,
+    )
+    vae = AutoencoderKL(
+        in_channels=3, out_channels=3, latent_channels=4, block_out_channels=(32, 64), layers_per_block=1,
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"), up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=64, hidden_size=32, intermediate_size=37, num_attention_heads=4, num_hidden_layers=2,
+        max_position_embeddings=16, bos_token_id=0, eos_token_id=1, pad_token_id=1,
+    ))
+    folder = tmp_path_factory.mktemp("tiny-stable-diffusion")
+    pipe = StableDiffusionPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=write_tiny_tokenizer(str(folder / "tokenizer_files")), unet=unet,
+        scheduler=DDIMScheduler(beta_schedule="scaled_linear", clip_sample=False, set_alpha_to_one=False),
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False,
+    )
+    pipe.save_pretrained(str(folder / "pipeline"))
+    return str(folder / "pipeline")
+
+
+def tiny_profiles(model_id):
+    profiles = image_generate.load_generation_profiles()
+    profiles[model_id] = dict(profiles["default"], num_inference_steps=2)
+    return profiles
+
+
+def make_jobs(model_id, save_root, num_images):
+    return [
+        (model_id, f"a photo of object {i}", image_generate.derive_seed(0, i), os.path.join(save_root, f"{i}.png"))
+        for i in range(num_images)
+    ]
+
+
+def run_jobs(jobs, model_id, **options):
+    results = image_generate.run_generation_workers(iter(jobs), len(jobs), [model_id], ["cpu"], tiny_profiles(model_id), worker_options(**options))
+    received = []
+    for save_path, error in results:
+        # every result is reported once its image is on disk
+        assert error is None
+        assert os.path.exists(save_path)
+        received.append(save_path)
+    return received
+
+
+def test_run_generation_workers_on_cpu(tmp_path, offline, tiny_model):
+    import numpy as np
+    from PIL import Image
+
+    # 5 jobs in batches of 2 leave a partial last batch
+    jobs = make_jobs(tiny_model, str(tmp_path / "run_1"), 5)
+    os.makedirs(tmp_path / "run_1")
+    assert sorted(run_jobs(jobs, tiny_model)) == sorted(job[3] for job in jobs)
+    assert not [name for name in os.listdir(tmp_path / "run_1") if name.endswith(".tmp")]
+
+    # seeds are derived from the image ids, so a rerun with another batch size gives the same images
+    rerun = make_jobs(tiny_model, str(tmp_path / "run_2"), 5)
+    os.makedirs(tmp_path / "run_2")
+    run_jobs(rerun, tiny_model, batch_size=1)
+
+    for (_, _, _, first), (_, _, _, second) in zip(jobs, rerun):
+        with Image.open(first) as image_1, Image.open(second) as image_2:
+            assert image_1.format == "PNG" and image_1.size == (32, 32)
+            # batched and single convolutions may round differently on CPU
+            assert np.abs(np.asarray(image_1, dtype=np.int16) - np.asarray(image_2, dtype=np.int16)).max() <= 2
+
+
+def test_existing_images_are_not_regenerated(tmp_path, offline, tiny_model):
+    jobs = make_jobs(tiny_model, str(tmp_path), 3)
+    run_jobs(jobs, tiny_model)
+    mtimes = [os.stat(job[3]).st_mtime_ns for job in jobs]
+
+    assert sorted(run_jobs(jobs, tiny_model)) == sorted(job[3] for job in jobs)
+    assert [os.stat(job[3]).st_mtime_ns for job in jobs] == mtimes
+
+
+def test_run_generation_workers_reports_load_errors(tmp_path, offline):
+    jobs = make_jobs(str(tmp_path / "missing_pipeline"), str(tmp_path), 3)
+    profiles = image_generate.load_generation_profiles()
+
+    results = list(image_generate.run_generation_workers(iter(jobs), len(jobs), [jobs[0][0]], ["cpu"], profiles, worker_options()))
+
+    assert sorted(save_path for save_path, _ in results) == sorted(job[3] for job in jobs)
+    assert all(error and error.startswith("failed to load") for _, error in results)
+    assert not any(os.path.exists(job[3]) for job in jobs)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+from import_time import ENTRY_POINTS, HEAVY_MODULES, measure_import_time
+
+
+# the wall-clock budget depends on the machine and is checked by benchmarks/import_time.py
+@pytest.mark.parametrize("script", ENTRY_POINTS)
+def test_entry_point_imports_no_heavy_backend(script):
+    _, _, packages, returncode = measure_import_time(script)
+
+    assert returncode == 0
+    assert not packages.intersection(HEAVY_MODULES)
@@ -0,0 +1,52 @@
+import io
+import json
+
+import pytest
+
+from utils.utils import iter_annotations, iter_json_array
+
+
+CHUNK_SIZES = range(1, 8)
+
+SAMPLES = [
+    {"image_path": "model_0/00001.png", "label": "AI-generated", "score": 10.25, "scale": -3e5, "weights": [0.5, -1.25e-3]},
+    {"image_path": "real/00002.jpg", "ground_truth": "line one\nline \"two\", with \\boxed{real} and ] [ , characters", "nested": {"a": [{"b": None}, True, False]}},
+    {"unicode": "été — 漢字", "escaped": "\\u00e9", "empty": {}, "empty_list": [], "number": 123456789012345},
+]
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", [
+    "[10.25, -3e5]",
+    "[0, -0.0, 1e10, 2E-3, 12345678901234567890]",
+    '["a", "long string split over many chunks", "with , and ] inside", ""]',
+    '[[1, [2, [3]]], {"k": {"k": [true, false, null]}}]',
+    "[]",
+    "[ \n ]",
+])
+def test_values_split_across_chunks(text, chunk_size):
+    assert list(iter_json_array(io.StringIO(text), chunk_size)) == json.loads(text)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_whitespace_longer_than_a_chunk(chunk_size):
+    text = " \n\t\r" * 5 + "[ \n  1 ,\n\n   2.5    ,   \"x\"   \n]  \n"
+    assert list(iter_json_array(io.StringIO(text), chunk_size)) == [1, 2.5, "x"]
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", ["[1,", "[1 2]", "[,1]", "[1", "[", "", "{\"a\": 1}", "[1, 2.]", "[\"unterminated]"])
+def test_malformed_input_raises(text, chunk_size):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text), chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_json_and_jsonl_files_parse_the_same(tmp_path, chunk_size):
+    json_path = tmp_path / "samples.json"
+    json_path.write_text("\n  " + json.dumps(SAMPLES, indent=2), encoding="utf-8")
+    jsonl_path = tmp_path / "samples.jsonl"
+    jsonl_path.write_text("\n".join(json.dumps(sample) for sample in SAMPLES) + "\n\n", encoding="utf-8")
+
+    assert list(iter_annotations(str(json_path), chunk_size)) == SAMPLES
+    assert list(iter_annotations(str(jsonl_path), chunk_size)) == SAMPLES
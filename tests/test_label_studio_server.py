@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("flask_cors")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "data_construction", "manual_annotation"))
+
+import label_studio_server_init
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    from PIL import Image
+
+    # relative folders, resolved against the working directory like on the command line
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("images/model_0")
+    os.makedirs("texts")
+    Image.new("RGB", (640, 480), (200, 30, 30)).save("images/model_0/a.png")
+    return tmp_path
+
+
+@pytest.fixture
+def preview_cache(workspace):
+    cache = label_studio_server_init.PreviewCache("preview_cache", 64 * 1024 ** 2, num_workers=1)
+    yield cache
+    cache.executor.shutdown()
+
+
+@pytest.mark.parametrize("production", [False, True])
+def test_preview_with_relative_cache_dir(workspace, preview_cache, production):
+    from PIL import Image
+
+    app = label_studio_server_init.create_app("images", "texts", production=production, preview_cache=preview_cache)
+    client = app.test_client()
+
+    response = client.get("/images/model_0/a.png?w=200&fmt=webp")
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+    with Image.open(os.path.join(preview_cache.cache_dir, os.listdir(preview_cache.cache_dir)[0])) as image:
+        assert image.size == (200, 150)
+    assert os.path.isdir(workspace / "preview_cache")
+
+    # cached previews are served again with their ETag
+    etag = response.headers["ETag"]
+    assert client.get("/images/model_0/a.png?w=200&fmt=webp", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_preview_rejects_bad_arguments(workspace, preview_cache):
+    client = label_studio_server_init.create_app("images", "texts", production=True, preview_cache=preview_cache).test_client()
+
+    assert client.get("/images/model_0/a.png?w=abc").status_code == 400
+    assert client.get("/images/model_0/a.png?w=200&fmt=gif").status_code == 400
+    assert client.get("/images/model_0/missing.png?w=200").status_code == 404
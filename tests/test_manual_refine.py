@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import threading
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "data_construction", "manual_annotation"))
+
+import annotation_high_level_manual_refine as manual_refine
+
+
+def make_image(path, content=b"\x89PNG fake image bytes"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def test_stage_image_links_by_content(tmp_path):
+    image = make_image(str(tmp_path / "images" / "model_0" / "a.png"))
+    copy = make_image(str(tmp_path / "images" / "model_1" / "b.png"))
+    staging_root = str(tmp_path / "staged")
+
+    staged = manual_refine.stage_image(image, staging_root)
+    staged_copy = manual_refine.stage_image(copy, staging_root)
+
+    assert staged == os.path.join(staging_root, "model_0", "a.png")
+    # identical contents share one object
+    assert os.path.samefile(staged, staged_copy)
+    objects = [name for _, _, names in os.walk(os.path.join(staging_root, ".objects")) for name in names]
+    assert len(objects) == 1
+    # staging again is a no-op
+    assert manual_refine.stage_image(image, staging_root) == staged
+
+
+def test_concurrent_staging_of_the_same_image(tmp_path, monkeypatch):
+    image = make_image(str(tmp_path / "images" / "model_0" / "a.png"))
+    errors = []
+
+    # the same image exported twice is staged by two tasks at once, a pause after each link lets them interleave
+    link_or_copy = manual_refine.link_or_copy
+
+    def slow_link_or_copy(src, dst):
+        link_or_copy(src, dst)
+        time.sleep(0.01)
+
+    monkeypatch.setattr(manual_refine, "link_or_copy", slow_link_or_copy)
+    for attempt in range(5):
+        staging_root = str(tmp_path / f"staged_{attempt}")
+        barrier = threading.Barrier(8)
+
+        def stage():
+            barrier.wait()
+            try:
+                manual_refine.stage_image(image, staging_root)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=stage) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+        assert os.path.samefile(image, os.path.join(staging_root, "model_0", "a.png"))
+        leftovers = [name for _, _, names in os.walk(staging_root) for name in names if name.endswith(".tmp")]
+        assert not leftovers
@@ -0,0 +1,95 @@
+import numpy as np
+
+
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+EMBEDDING_BACKENDS = ["torch", "onnx", "int8"]
+
+# maximum absolute drift of cosine scores against the fp32 PyTorch reference accepted for each backend
+PARITY_TOLERANCE = {
+    "torch": 1e-5,
+    "onnx": 1e-3,
+    "int8": 3e-2,
+}
+
+
+
+def load_embedding_model(backend="torch", model_name=DEFAULT_EMBEDDING_MODEL, num_threads=None, device=None):
+    """
+    load a sentence embedding model with the given inference backend
+
+    :param backend: "torch" (fp32 PyTorch), "onnx" (ONNX Runtime, CPU) or "int8" (dynamically quantized PyTorch, CPU)
+    :param model_name: SentenceTransformer model name or local path
+    :param num_threads: number of intra-op threads used for inference (None keeps the library default)
+    :param device: device for the "torch" backend (None lets SentenceTransformer decide)
+    :return: model exposing SentenceTransformer's `encode`
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if backend == "torch":
+        model = SentenceTransformer(model_name, device=device)
+
+    elif backend == "onnx":
+        # requires `pip install optimum[onnxruntime]`, the model is exported to ONNX on first use
+        import onnxruntime as ort
+
+        session_options = ort.SessionOptions()
+        if num_threads:
+            session_options.intra_op_num_threads = num_threads
+            session_options.inter_op_num_threads = 1
+        model = SentenceTransformer(
+            model_name,
+            device="cpu",
+            backend="onnx",
+            model_kwargs={"provider": "CPUExecutionProvider", "session_options": session_options},
+        )
+
+    elif backend == "int8":
+        # quantize weights of all linear layers to int8, activations are quantized on the fly
+        model = SentenceTransformer(model_name, device="cpu")
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    else:
+        raise ValueError(f"Unknown embedding backend: {backend}, expected one of {EMBEDDING_BACKENDS}")
+
+    return model
+
+
+def cosine_score_matrix(model, sentences1, sentences2, batch_size=32):
+    """
+    compute the cosine similarity matrix between two lists of sentences with a single encode call
+    """
+    embeddings = model.encode(
+        list(sentences1) + list(sentences2),
+        batch_size=batch_size,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+    embedding1, embedding2 = embeddings[:len(sentences1)], embeddings[len(sentences1):]
+    return embedding1 @ embedding2.T
+
+
+def parity_check(model, reference_model, sentence_pairs, batch_size=32):
+    """
+    report the drift of cosine scores computed by `model` versus `reference_model`
+
+    :param sentence_pairs: list of (sentences1, sentences2) tuples, e.g. ground truth and generated points of a sample
+    :return: dict with the maximum and mean absolute drift over all score entries
+    """
+    drifts = []
+    for sentences1, sentences2 in sentence_pairs:
+        if not sentences1 or not sentences2:
+            continue
+        scores = cosine_score_matrix(model, sentences1, sentences2, batch_size)
+        reference_scores = cosine_score_matrix(reference_model, sentences1, sentences2, batch_size)
+        drifts.append(np.abs(scores - reference_scores).ravel())
+
+    if not drifts:
+        return {"num_pairs": 0, "max_drift": 0.0, "mean_drift": 0.0}
+
+    drifts = np.concatenate(drifts)
+    return {"num_pairs": len(sentence_pairs), "max_drift": float(drifts.max()), "mean_drift": float(drifts.mean())}
@@ -1,17 +1,24 @@
 import os
 import io
+import sys
 import time
 import base64
 from mimetypes import guess_type
-import openai
-from openai import AzureOpenAI
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from PIL import Image
 
-from typing import List, Optional, Union
+from typing import TYPE_CHECKING, List, Optional, Union
 
 from .constants import *
 
+# openai, azure-identity and PIL are imported inside the functions that need them to keep startup fast
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+
+def is_pil_image(obj):
+    # an object can only be a PIL image if PIL has already been imported by the caller
+    pil_image = sys.modules.get("PIL.Image")
+    return pil_image is not None and isinstance(obj, pil_image.Image)
 
 
 def local_image_to_data_url(image_source, image_format=None):
@@ -30,7 +37,7 @@ def local_image_to_data_url(image_source, image_format=None):
         with open(image_source, "rb") as image_file:
             image_data = image_file.read()
     
-    elif isinstance(image_source, Image.Image):
+    elif is_pil_image(image_source):
         # Handle PIL.Image object input
         image_format = image_format or image_source.format or 'PNG'
         image_buffer = io.BytesIO()
@@ -63,6 +70,8 @@ def gpt4o_response(
         max_tokens: int = 2000,
         ):
 
+    import openai
+
     client = openai.OpenAI(api_key=OPENAI_API_KEY)
 
     retry_count = 0
@@ -142,7 +151,7 @@ def gpt4o_response(
 # you can use this version of gpt-4o if Azure OpenAI is available 
 def gpt4o_response_legacy(
         prompt: Union[str, List[str]], 
-        image_path: Union[Optional[str], Image.Image, List[str], List[Image.Image]] = None, 
+        image_path: Union[Optional[str], "Image.Image", List[str], List["Image.Image"]] = None, 
         endpoint_url = "https://mcg-openai-swedencentral-b.openai.azure.com/",
         deployment_name = "gpt-4o",
         max_retry: int = 15, 
@@ -150,6 +159,10 @@ def gpt4o_response_legacy(
         verbose: bool = True,
         ):
 
+    import openai
+    from openai import AzureOpenAI
+    from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+
     endpoint = os.getenv("ENDPOINT_URL", endpoint_url)
     deployment = os.getenv("DEPLOYMENT_NAME", deployment_name)
 
@@ -167,7 +180,7 @@ def gpt4o_response_legacy(
     response = None
         
     prompts = [prompt] if isinstance(prompt, str) else prompt
-    image_paths = [image_path] if (isinstance(image_path, str) or isinstance(image_path, Image.Image)) else image_path
+    image_paths = [image_path] if (isinstance(image_path, str) or is_pil_image(image_path)) else image_path
 
     message = list()
     for prompt in prompts:
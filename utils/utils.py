@@ -1,25 +1,117 @@
+import os
 import re
+import json
+
+
+# all markers of the annotation grammar in one pattern; \boxed{ only consumes its opening so that markers
+# inside the braces are still seen, the boxed content is captured by the lookahead
+ANNOTATION_TOKEN_PATTERN = re.compile(
+    r"<(begin|end)_of_(point|low_level_errors|high_level_errors)>|\\boxed\{(?=(.*?)\})"
+)
+
+
+class AnnotationRecord:
+    """
+    structured view of an annotation
+
+    low_level / high_level: content of the low-level and high-level error sections (None if missing)
+    prefix / points / conclusion: parsed from the high-level section, or from the whole text without one
+    label: content of the first \boxed{} (None if missing)
+    """
+    __slots__ = ("low_level", "high_level", "prefix", "points", "conclusion", "label")
+
+    def __init__(self, low_level, high_level, prefix, points, conclusion, label):
+        self.low_level = low_level
+        self.high_level = high_level
+        self.prefix = prefix
+        self.points = points
+        self.conclusion = conclusion
+        self.label = label
+
+    def __repr__(self):
+        return (f"AnnotationRecord(label={self.label!r}, points={len(self.points)}, "
+                f"low_level={self.low_level is not None}, high_level={self.high_level is not None})")
+
+
+def _tokenize(text):
+    """
+    scan the text once and return positions of point markers, section boundaries and the first boxed label
+    """
+    begins, ends = [], []
+    sections = {}
+    label = None
+
+    for match in ANNOTATION_TOKEN_PATTERN.finditer(text):
+        kind, name = match.group(1), match.group(2)
+        if name == "point":
+            (begins if kind == "begin" else ends).append((match.start(), match.end()))
+        elif name:
+            # keep the first begin marker and the first end marker after it, like a non-greedy search
+            if kind == "begin":
+                sections.setdefault(name, [match.end(), None])
+            elif name in sections and sections[name][1] is None:
+                sections[name][1] = match.start()
+        elif label is None:
+            label = match.group(3)
+
+    bounds = {name: (start, stop) for name, (start, stop) in sections.items() if stop is not None}
+    return begins, ends, bounds, label
+
+
+def _split_points(text, start, stop, begins, ends):
+    """
+    split text[start:stop] into prefix, points and conclusion with the same semantics as splitting the
+    stripped text on <begin_of_point> and each section on its first <end_of_point>
+    """
+    region = text[start:stop]
+    stripped = region.strip()
+    start += len(region) - len(region.lstrip())
+    stop = start + len(stripped)
+
+    begins = [token for token in begins if start <= token[0] and token[1] <= stop]
+    ends = [token for token in ends if start <= token[0] and token[1] <= stop]
+
+    prefix_stop = begins[0][0] if begins else stop
+    prefix = text[start:prefix_stop].strip() if prefix_stop > start else None
 
-def parse_text(text):
-    text = text.strip()
-    
-    sections = re.split(r"<begin_of_point>", text)
-    prefix = sections[0].strip() if sections[0] else None
-    
     points = []
     conclusion = None
-    
-    for section in sections[1:]:
-        parts = section.split("<end_of_point>", 1)
-        if len(parts) == 2:
-            points.append(parts[0].strip())
-            conclusion = parts[1].strip() if parts[1] else None
+    k = 0
+    for i, (_, point_start) in enumerate(begins):
+        section_stop = begins[i + 1][0] if i + 1 < len(begins) else stop
+        while k < len(ends) and ends[k][0] < point_start:
+            k += 1
+        if k < len(ends) and ends[k][1] <= section_stop:
+            points.append(text[point_start:ends[k][0]].strip())
+            tail = text[ends[k][1]:section_stop]
+            conclusion = tail.strip() if tail else None
         else:
-            points.append(parts[0].strip())
-    
+            points.append(text[point_start:section_stop].strip())
+
     return prefix, points, conclusion
 
 
+def parse_annotation(text):
+    """
+    parse sections, points, conclusion and boxed label of an annotation in a single scan
+    """
+    begins, ends, bounds, label = _tokenize(text)
+
+    low_level = text[slice(*bounds["low_level_errors"])].strip() if "low_level_errors" in bounds else None
+    high_level = text[slice(*bounds["high_level_errors"])].strip() if "high_level_errors" in bounds else None
+
+    # points come from the high-level section, or from the whole text if it is missing or empty
+    start, stop = bounds["high_level_errors"] if high_level else (0, len(text))
+    prefix, points, conclusion = _split_points(text, start, stop, begins, ends)
+
+    return AnnotationRecord(low_level, high_level, prefix, points, conclusion, label)
+
+
+def parse_text(text):
+    begins, ends, _, _ = _tokenize(text)
+    return _split_points(text, 0, len(text), begins, ends)
+
+
 def extract_content_by_regex(text, start_marker, end_marker):
     """
     extract content between start marker and end marker
@@ -41,4 +133,145 @@ def get_boxed_content(text):
     if content:
         return content[0]
     
-    return None
\ No newline at end of file
+    return None
+
+def iter_json_array(f, chunk_size=1 << 16):
+    """
+    incrementally parse a top-level JSON array from a file object, yielding one element at a time
+    """
+    decoder = json.JSONDecoder()
+    buffer, idx, eof = "", 0, False
+
+    def refill():
+        nonlocal buffer, idx, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        # drop consumed text so memory stays bounded by the largest element
+        buffer, idx = buffer[idx:] + chunk, 0
+
+    def skip_whitespace(pos):
+        while pos < len(buffer) and buffer[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    def next_char():
+        """
+        first non-whitespace character from idx on, reading more chunks as needed ("" at EOF)
+        """
+        nonlocal idx
+        while True:
+            idx = skip_whitespace(idx)
+            if idx < len(buffer) or eof:
+                return buffer[idx:idx + 1]
+            refill()
+
+    if next_char() != "[":
+        raise ValueError("Expected a JSON array at the top level")
+    idx += 1
+    if next_char() == "]":
+        return
+
+    while True:
+        if not next_char():
+            raise json.JSONDecodeError("Unterminated array", buffer, idx)
+        try:
+            element, end = decoder.raw_decode(buffer, idx)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            refill()
+            continue
+
+        # a value cut at the chunk boundary may still decode (e.g. "10." of "10.25"), so an element is only
+        # accepted once the delimiter after it has been read
+        stop = skip_whitespace(end)
+        if stop == len(buffer) or buffer[stop] not in ",]":
+            if eof:
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, stop)
+            refill()
+            continue
+        yield element
+        idx = stop + 1
+        if buffer[stop] == "]":
+            return
+
+
+def iter_annotations(path, chunk_size=1 << 16):
+    """
+    stream samples from a JSONL file or a JSON array file without loading the whole file
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+
+        if first == "[":
+            yield from iter_json_array(f, chunk_size)
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def load_skip_list(path):
+    """
+    load a skip list (one image path per line, `#` starts a comment) as a set of absolute paths, empty if
+    path is None
+    """
+    if not path:
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return {os.path.abspath(line.strip()) for line in f if line.strip() and not line.startswith("#")}
+
+
+def filter_skipped(paths, skip_list):
+    """
+    drop the paths listed in a skip list file (e.g. near-duplicates found by data_construction/image_dedup.py),
+    keeping the order of the others
+    """
+    skipped = load_skip_list(skip_list)
+    if not skipped:
+        return list(paths)
+    kept = [path for path in paths if os.path.abspath(path) not in skipped]
+    print(f"Skipping {len(paths) - len(kept)} images listed in {skip_list}")
+    return kept
+
+
+def load_rejected_images(manifest):
+    """
+    absolute paths of the images rejected in a filter manifest (JSONL with "path" and "accepted"), empty if
+    manifest is None
+    """
+    if not manifest:
+        return set()
+    return {os.path.abspath(record["path"]) for record in iter_annotations(manifest) if not record["accepted"]}
+
+
+def build_packed_prompt(prompt, num_images):
+    """
+    wrap a single-image prompt so that one request answers it for num_images attached images, each answer
+    enclosed in indexed markers that split_packed_response can find
+    """
+    return (
+        f"You are given {num_images} images, numbered from 1 to {num_images} in the order they are attached. "
+        f"Complete the task below for every image separately and independently, without comparing the images. "
+        f"Place the answer for image i between `<begin_of_image_i>` and `<end_of_image_i>` "
+        f"(e.g. `<begin_of_image_1>` ... `<end_of_image_1>`), and answer for all {num_images} images in order.\n\n"
+        f"Task for every image:\n{prompt}"
+    )
+
+
+def split_packed_response(response, num_images):
+    """
+    split the response to a packed prompt into one answer per image, None for answers that are missing, empty
+    or contain markers of another image
+    """
+    answers = []
+    for index in range(1, num_images + 1):
+        content = extract_content_by_regex(response or "", f"<begin_of_image_{index}>", f"<end_of_image_{index}>")
+        if not content or "_of_image_" in content:
+            content = None
+        answers.append(content)
+    return answers